@@ -1,200 +1,648 @@
+import argparse
+import asyncio
+import hashlib
 import json
 import os
-import re
-from collections import defaultdict
+import random
+import sys
 from datetime import datetime
 
 import numpy as np
-import pandas as pd
-import seaborn as sns
-from rouge_score import rouge_scorer
-from scipy import stats
-from sentence_transformers import SentenceTransformer
-import torch
-import matplotlib.pyplot as plt
 
-from llm_utils import LLMClient, LLMConfig
+from embedding_store import EmbeddingStore
+from jsonl_io import JsonlWriter, iter_jsonl, load_index
+from metrics_engine import Interner, bleu1_scores, bleu_tokenize, rougeL_scores, rowwise_cosine
+from online_stats import OnlineAggregator, paired_ttest
+from prompt_layout import PROMPT_LAYOUT, PROMPT_LAYOUTS, assemble
+from resampling import pairwise_resampling
+from structured_output import object_schema
+
+# pandas, scipy, seaborn/matplotlib, rouge_score, torch/sentence_transformers and
+# openai are imported inside the subcommand paths that need them, so e.g.
+# `analyze_results.py stats` starts without loading a model stack
 
 ROOT = os.path.dirname(os.path.dirname(__file__))
 OUTPUT_PATH = os.path.join(ROOT, "results", "model_outputs", "llm_outputs.jsonl")
 METRICS_PATH = os.path.join(ROOT, "results", "metrics", "metrics.json")
 JUDGE_PATH = os.path.join(ROOT, "results", "metrics", "judgments.jsonl")
 PLOT_PATH = os.path.join(ROOT, "results", "plots", "method_comparison.png")
+ROWS_PATH = os.path.join(ROOT, "results", "metrics", "per_example_metrics.parquet")
+AGREEMENT_PATH = os.path.join(ROOT, "results", "metrics", "judge_agreement.json")
 
 MODEL_JUDGE = os.getenv("MODEL_JUDGE", "gpt-4.1")
+SBERT_MODEL = "all-MiniLM-L6-v2"
+JUDGE_CONCURRENCY = int(os.getenv("JUDGE_CONCURRENCY", "8"))
+JUDGE_MAX_CONCURRENCY = int(os.getenv("JUDGE_MAX_CONCURRENCY", "32"))
+# "single" judges one (example, method) per request; "multi" scores all distinct
+# candidates of an example in one request
+JUDGE_MODES = ("single", "multi")
+JUDGE_MODE = os.getenv("JUDGE_MODE", "single")
+BOOTSTRAP_RESAMPLES = int(os.getenv("BOOTSTRAP_RESAMPLES", "10000"))
 
 METHODS = ["no_rewrite", "direct_rewrite", "always_clarify", "gated_clarify"]
+ROW_KEYS = ["example_id", "method", "rewrite_hash"]
+METRIC_COLUMNS = ["bleu1", "rougeL", "sbert_cosine"]
+PAIRED_METHODS = ("direct_rewrite", "gated_clarify")
+CLARIFICATION_ORDER = ["always_clarify", "gated_clarify", "direct_rewrite", "no_rewrite"]
+
+
+def available_methods(records):
+    # Runs restricted with --methods only carry a subset of the outputs
+    return [m for m in METHODS if records and all(m in r["outputs"] for r in records)]
+
+
+def load_outputs(path=OUTPUT_PATH):
+    # A targeted re-run appends a newer record for the same example; keep the last
+    latest = {}
+    for obj in iter_jsonl(path):
+        latest[obj["example_id"]] = obj
+    return list(latest.values())
 
 
-def tokenize(text: str):
-    return re.findall(r"\w+|[^\w\s]", text.lower())
+def rewrite_hash(rec, method):
+    # Same digest as the metrics rows, so a rerun that changes a rewrite is re-judged
+    return pair_hash(rec["gold_rewrite"], rec["outputs"][method]["rewrite"])
 
 
-def sentence_bleu(reference: str, hypothesis: str) -> float:
-    ref = tokenize(reference)
-    hyp = tokenize(hypothesis)
-    if not hyp:
-        return 0.0
-    # Simple BLEU-1 to avoid length issues
-    overlap = sum(1 for t in hyp if t in ref)
-    return overlap / max(len(hyp), 1)
+def judgment_key(obj):
+    # Rows written before rewrite_hash was recorded have an empty hash
+    return f"{obj['example_id']}\t{obj['method']}\t{obj.get('rewrite_hash', '')}"
 
 
-def load_outputs():
-    data = []
-    with open(OUTPUT_PATH, "r") as f:
-        for line in f:
-            data.append(json.loads(line))
-    return data
+def judged_keys():
+    # Resume only needs the sidecar index, not a parse of every judgment
+    return {tuple(key.split("\t", 2)) for key in load_index(JUDGE_PATH, judgment_key)}
 
 
-def load_judgments():
-    if not os.path.exists(JUDGE_PATH):
+def load_judgments(path=JUDGE_PATH, records=None):
+    # Given the current outputs, rows judged on an older rewrite are skipped
+    if not os.path.exists(path):
         return {}
+    current = None
+    if records is not None:
+        current = {(r["example_id"], m): rewrite_hash(r, m) for r in records for m in METHODS if m in r["outputs"]}
     out = {}
-    with open(JUDGE_PATH, "r") as f:
-        for line in f:
-            obj = json.loads(line)
-            out[(obj["example_id"], obj["method"])] = obj
+    for obj in iter_jsonl(path):
+        key = (obj["example_id"], obj["method"])
+        if current is not None and obj.get("rewrite_hash") not in (None, current.get(key)):
+            continue
+        out[key] = obj
     return out
 
 
-def save_judgment(obj):
-    with open(JUDGE_PATH, "a") as f:
-        f.write(json.dumps(obj, ensure_ascii=False) + "\n")
+JUDGE_SYSTEM = (
+    "You are evaluating whether a rewrite preserves the user's intent. "
+    "Score from 1 (intent changed) to 5 (intent fully preserved). "
+    "Return JSON only."
+)
+
+JUDGE_MULTI_SYSTEM = (
+    "You are evaluating whether rewrites preserve the user's intent. "
+    "Score each candidate independently from 1 (intent changed) to 5 (intent fully preserved). "
+    "Return JSON only."
+)
+
+
+JUDGE_SCHEMA = object_schema({"score": {"type": "integer"}, "rationale": {"type": "string"}}, optional=["rationale"])
+
+
+def judge_config(labels=None):
+    # labels: the candidate labels of a multi-candidate prompt, None for a single candidate
+    from llm_utils import LLMConfig
 
+    if labels is None:
+        return LLMConfig(model=MODEL_JUDGE, temperature=0, max_tokens=200,
+                         schema=JUDGE_SCHEMA, schema_name="judge")
+    return LLMConfig(model=MODEL_JUDGE, temperature=0, max_tokens=200 * len(labels),
+                     # Unscored labels are re-judged one at a time rather than retried
+                     schema=object_schema({label: JUDGE_SCHEMA for label in labels}, optional=labels),
+                     schema_name="judge_multi")
 
-def run_judging(records):
-    client = LLMClient(model=MODEL_JUDGE)
-    cfg = LLMConfig(model=MODEL_JUDGE, temperature=0, max_tokens=200)
 
-    system = (
-        "You are evaluating whether a rewrite preserves the user's intent. "
-        "Score from 1 (intent changed) to 5 (intent fully preserved). "
-        "Return JSON only."
+def judge_prompt(rec, method):
+    # Follows the conversation block added by prompt_layout.assemble
+    rewrite = rec["outputs"][method]["rewrite"]
+    return (
+        f"Current question: {rec['question']}\n\n"
+        f"Candidate rewrite: {rewrite}\n\n"
+        f"Gold rewrite (for reference only): {rec['gold_rewrite']}\n\n"
+        "Return JSON: {\"score\": 1-5, \"rationale\": \"short\"}"
     )
 
-    existing = load_judgments()
 
-    for rec in records:
-        example_id = rec["example_id"]
-        context = rec["context"]
-        question = rec["question"]
-        gold = rec["gold_rewrite"]
+def candidate_slate(rec, methods):
+    """Map anonymous labels A, B, ... to (rewrite, methods) for the distinct rewrites.
+
+    The order is shuffled per example so neither position nor method name lines up
+    with a label; the shuffle is seeded by example_id, so a rerun renders the same
+    prompt and is answered from the response cache.
+    """
+    rewrites = {}
+    for method in methods:
+        rewrites.setdefault(rec["outputs"][method]["rewrite"], []).append(method)
+    order = list(rewrites.items())
+    seed = hashlib.blake2b(str(rec["example_id"]).encode("utf-8"), digest_size=8).digest()
+    random.Random(seed).shuffle(order)
+    return {chr(ord("A") + i): candidate for i, candidate in enumerate(order)}
+
+
+def multi_judge_prompt(rec, slate):
+    candidates = "\n".join(f"[{label}] {rewrite}" for label, (rewrite, _) in slate.items())
+    schema = ", ".join(f"\"{label}\": {{\"score\": 1-5, \"rationale\": \"short\"}}" for label in slate)
+    return (
+        f"Current question: {rec['question']}\n\n"
+        f"Candidate rewrites (in no particular order):\n{candidates}\n\n"
+        f"Gold rewrite (for reference only): {rec['gold_rewrite']}\n\n"
+        f"Return JSON: {{{schema}}}"
+    )
+
 
+def multi_scores(data, slate):
+    # Labels with a usable 1-5 score; the others are re-judged one at a time
+    scored = {}
+    for label in slate:
+        entry = data.get(label) if isinstance(data, dict) else None
+        score = entry.get("score") if isinstance(entry, dict) else None
+        if isinstance(score, (int, float)) and not isinstance(score, bool) and 1 <= score <= 5:
+            scored[label] = entry
+    return scored
+
+
+def judgment_record(example_id, method, digest, resp, **extra):
+    return {
+        "example_id": example_id,
+        "method": method,
+        "rewrite_hash": digest,
+        "score": resp["data"]["score"],
+        "rationale": resp["data"].get("rationale", ""),
+        "usage": resp["usage"],
+        **extra,
+        "timestamp": datetime.now().isoformat(),
+    }
+
+
+def multi_judgment_records(rec, slate, resp):
+    """Split a multi-candidate reply into judgment rows plus the labels it failed to score."""
+    scored = multi_scores(resp["data"], slate)
+    rows, missing = [], []
+    # The request's usage is booked once, on the first row written for it
+    usage = resp["usage"]
+    for label, (_, methods) in slate.items():
+        if label not in scored:
+            missing.append(label)
+            continue
+        for method in methods:
+            rows.append(judgment_record(rec["example_id"], method, rewrite_hash(rec, method),
+                                        {"data": scored[label], "usage": usage},
+                                        judge_mode="multi", candidate=label, candidates=len(slate)))
+            usage = {}
+    return rows, missing
+
+
+def pending_judgments(records, existing):
+    # existing holds (example_id, method, rewrite_hash); a row without a hash
+    # predates the field and is taken to match the current rewrite
+    for rec in records:
         for method in METHODS:
-            key = (example_id, method)
-            if key in existing:
+            if method not in rec["outputs"]:
                 continue
+            key = (rec["example_id"], method)
+            if key + (rewrite_hash(rec, method),) not in existing and key + ("",) not in existing:
+                yield rec, method
 
-            rewrite = rec["outputs"][method]["rewrite"]
-            user = (
-                f"Conversation:\n{context}\n\nCurrent question: {question}\n\n"
-                f"Candidate rewrite: {rewrite}\n\n"
-                f"Gold rewrite (for reference only): {gold}\n\n"
-                "Return JSON: {\"score\": 1-5, \"rationale\": \"short\"}"
-            )
-            resp = client.chat_json(system, user, cfg)
-            obj = {
-                "example_id": example_id,
-                "method": method,
-                "score": resp["data"]["score"],
-                "rationale": resp["data"].get("rationale", ""),
-                "usage": resp["usage"],
-                "timestamp": datetime.now().isoformat(),
-            }
-            save_judgment(obj)
+
+def judge_groups(records, existing, layout=PROMPT_LAYOUT):
+    # Identical (context, question, candidate, gold) tuples render the same prompt,
+    # e.g. gated_clarify copying direct_rewrite; each prompt is judged once
+    groups = {}
+    for rec, method in pending_judgments(records, existing):
+        messages = assemble(layout, JUDGE_SYSTEM, rec["context"], judge_prompt(rec, method))
+        groups.setdefault(messages, []).append((rec["example_id"], method, rewrite_hash(rec, method)))
+    return groups
+
+
+def multi_judge_slates(records, existing, layout=PROMPT_LAYOUT):
+    """One (messages, record, slate) per example with pending judgments."""
+    pending = {}
+    for rec, method in pending_judgments(records, existing):
+        pending.setdefault(rec["example_id"], (rec, []))[1].append(method)
+    slates = []
+    for rec, methods in pending.values():
+        slate = candidate_slate(rec, methods)
+        messages = assemble(layout, JUDGE_MULTI_SYSTEM, rec["context"], multi_judge_prompt(rec, slate))
+        slates.append((messages, rec, slate))
+    return slates
+
+
+def fallback_groups(rec, slate, labels, layout):
+    # Single-candidate prompts for the labels a multi reply left unscored
+    groups = {}
+    for label in labels:
+        _, methods = slate[label]
+        messages = assemble(layout, JUDGE_SYSTEM, rec["context"], judge_prompt(rec, methods[0]))
+        groups.setdefault(messages, []).extend((rec["example_id"], method, rewrite_hash(rec, method))
+                                               for method in methods)
+    return groups
+
+
+def report_dedup(groups):
+    total = sum(len(members) for members in groups.values())
+    print(f"Judging {len(groups)} unique prompts for {total} pending judgments")
+
+
+def report_slates(slates):
+    total = sum(len(methods) for _, _, slate in slates for _, methods in slate.values())
+    candidates = sum(len(slate) for _, _, slate in slates)
+    print(f"Judging {candidates} distinct candidates for {total} pending judgments in {len(slates)} prompts")
+
+
+async def judge_group_async(client, messages, members, writer):
+    resp = await client.chat_json(*messages, judge_config())
+    for example_id, method, digest in members:
+        writer.write(judgment_record(example_id, method, digest, resp))
+
+
+async def judge_slate_async(client, messages, rec, slate, writer, layout):
+    resp = await client.chat_json(*messages, judge_config(list(slate)))
+    rows, missing = multi_judgment_records(rec, slate, resp)
+    for row in rows:
+        writer.write(row)
+    for fallback, members in fallback_groups(rec, slate, missing, layout).items():
+        await judge_group_async(client, fallback, members, writer)
+    return len(missing)
+
+
+async def run_judging_async(groups, writer, client, concurrency):
+    pending = iter(groups.items())
+
+    # Workers share one iterator, so at most `concurrency` prompts are in flight
+    async def worker():
+        for messages, members in pending:
+            await judge_group_async(client, messages, members, writer)
+
+    await asyncio.gather(*(worker() for _ in range(max(concurrency, 1))))
+
+
+async def run_multi_judging_async(slates, writer, client, concurrency, layout):
+    pending = iter(slates)
+    fallbacks = 0
+
+    async def worker():
+        nonlocal fallbacks
+        for messages, rec, slate in pending:
+            missing = await judge_slate_async(client, messages, rec, slate, writer, layout)
+            fallbacks += missing
+
+    await asyncio.gather(*(worker() for _ in range(max(concurrency, 1))))
+    return fallbacks
+
+
+def judge_client(concurrency, max_concurrency):
+    from llm_utils import AsyncLLMClient
+    from rate_limit import AdaptiveConcurrency
+
+    # Rate budgets come from RPM_LIMIT / TPM_LIMIT via the shared limiter
+    controller = AdaptiveConcurrency(initial=concurrency, maximum=max(max_concurrency, concurrency))
+    return AsyncLLMClient(model=MODEL_JUDGE, concurrency=controller)
+
+
+def run_judging(records, concurrency=JUDGE_CONCURRENCY, max_concurrency=JUDGE_MAX_CONCURRENCY,
+                layout=PROMPT_LAYOUT, mode=JUDGE_MODE):
+    client = judge_client(concurrency, max_concurrency)
+    limit = client.concurrency.maximum
+    with JsonlWriter(JUDGE_PATH, key_fn=judgment_key) as writer:
+        if mode == "multi":
+            slates = multi_judge_slates(records, judged_keys(), layout)
+            report_slates(slates)
+            fallbacks = asyncio.run(run_multi_judging_async(slates, writer, client, limit, layout))
+            print(f"Re-judged {fallbacks} candidates one at a time after unusable multi-candidate replies")
+        else:
+            groups = judge_groups(records, judged_keys(), layout)
+            report_dedup(groups)
+            asyncio.run(run_judging_async(groups, writer, client, limit))
+    print("Judge prompt prefix cache:", json.dumps(client.usage.stats()))
+    print(f"Repaired {client.repaired_replies} malformed judge replies locally")
+
+
+def judge_batch_groups(groups, backend, name, writer):
+    from batch_utils import batch_scope, run_batch
+
+    # The first (example, method) of each group names the request
+    requests = []
+    fan_out = {}
+    for (system, user), members in groups.items():
+        custom_id = "{}:{}".format(*members[0][:2])
+        requests.append((custom_id, system, user, judge_config()))
+        fan_out[custom_id] = members
+    results = run_batch(requests, backend, f"{batch_scope(writer.path)}-{name}")
+    for custom_id, members in fan_out.items():
+        resp = results.get(custom_id)
+        if resp is None:
+            continue
+        for example_id, method, digest in members:
+            writer.write(judgment_record(example_id, method, digest, resp))
+
+
+def run_judging_batch(records, backend, layout=PROMPT_LAYOUT, mode=JUDGE_MODE):
+    from batch_utils import batch_scope, run_batch
+
+    if mode != "multi":
+        groups = judge_groups(records, judged_keys(), layout)
+        report_dedup(groups)
+        with JsonlWriter(JUDGE_PATH, key_fn=judgment_key) as writer:
+            judge_batch_groups(groups, backend, "judge", writer)
+        return
+
+    slates = multi_judge_slates(records, judged_keys(), layout)
+    report_slates(slates)
+    requests = [(f"{rec['example_id']}:multi", system, user, judge_config(list(slate)))
+                for (system, user), rec, slate in slates]
+    results = run_batch(requests, backend, f"{batch_scope(JUDGE_PATH)}-judge-multi")
+    fallback = {}
+    with JsonlWriter(JUDGE_PATH, key_fn=judgment_key) as writer:
+        for _, rec, slate in slates:
+            resp = results.get(f"{rec['example_id']}:multi")
+            if resp is None:
+                continue
+            rows, missing = multi_judgment_records(rec, slate, resp)
+            for row in rows:
+                writer.write(row)
+            for messages, members in fallback_groups(rec, slate, missing, layout).items():
+                fallback.setdefault(messages, []).extend(members)
+        if fallback:
+            report_dedup(fallback)
+            judge_batch_groups(fallback, backend, "judge-fallback", writer)
+
+
+class JudgmentBuffer:
+    # Writer stand-in for judge passes that must not touch judgments.jsonl
+    def __init__(self):
+        self.rows = []
+
+    def write(self, row):
+        self.rows.append(row)
+
+
+def prompt_cost(prompts):
+    from rate_limit import CHARS_PER_TOKEN
+
+    return {
+        "requests": len(prompts),
+        "est_prompt_tokens": sum((len(system) + len(user)) // CHARS_PER_TOKEN for system, user in prompts),
+    }
 
 
-def compute_metrics(records):
-    scorer = rouge_scorer.RougeScorer(["rougeL"], use_stemmer=True)
+def score_agreement(single, multi):
+    """Agreement between two {(example_id, method): score} maps on their shared keys."""
+    from scipy import stats
+
+    keys = sorted(set(single) & set(multi))
+    if not keys:
+        return {"n": 0}
+    a = np.array([single[k] for k in keys], dtype=np.float64)
+    b = np.array([multi[k] for k in keys], dtype=np.float64)
+    diff = b - a
+    varied = len(keys) > 1 and a.std() > 0 and b.std() > 0
+    return {
+        "n": len(keys),
+        "exact": float(np.mean(diff == 0)),
+        "within_one": float(np.mean(np.abs(diff) <= 1)),
+        "mean_abs_diff": float(np.mean(np.abs(diff))),
+        "mean_diff": float(np.mean(diff)),
+        "pearson": float(stats.pearsonr(a, b)[0]) if varied else None,
+        "spearman": float(stats.spearmanr(a, b)[0]) if varied else None,
+    }
+
 
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    model = SentenceTransformer("all-MiniLM-L6-v2", device=device)
-    batch_size = 64 if device == "cuda" else 16
+def judge_agreement(records, concurrency=JUDGE_CONCURRENCY, max_concurrency=JUDGE_MAX_CONCURRENCY,
+                    layout=PROMPT_LAYOUT):
+    """Judge the same outputs one candidate at a time and all candidates at once, and compare."""
+    groups = judge_groups(records, set(), layout)
+    slates = multi_judge_slates(records, set(), layout)
+    single_rows, multi_rows = JudgmentBuffer(), JudgmentBuffer()
+    client = judge_client(concurrency, max_concurrency)
+    limit = client.concurrency.maximum
 
-    metrics = defaultdict(list)
+    async def both():
+        await run_judging_async(groups, single_rows, client, limit)
+        return await run_multi_judging_async(slates, multi_rows, client, limit, layout)
 
-    golds = [r["gold_rewrite"] for r in records]
-    gold_embs = model.encode(golds, batch_size=batch_size, convert_to_tensor=True, normalize_embeddings=True)
+    fallbacks = asyncio.run(both())
+    single = {(r["example_id"], r["method"]): r["score"] for r in single_rows.rows}
+    multi = {(r["example_id"], r["method"]): r["score"] for r in multi_rows.rows if r.get("judge_mode") == "multi"}
 
+    by_method = {}
     for method in METHODS:
-        hyps = [r["outputs"][method]["rewrite"] for r in records]
-        hyp_embs = model.encode(hyps, batch_size=batch_size, convert_to_tensor=True, normalize_embeddings=True)
+        subset = {k for k in single if k[1] == method}
+        if subset:
+            by_method[method] = score_agreement({k: single[k] for k in subset}, multi)
+            by_method[method]["single_mean"] = float(np.mean([single[k] for k in subset]))
+            scored = [multi[k] for k in subset if k in multi]
+            by_method[method]["multi_mean"] = float(np.mean(scored)) if scored else None
+    # Mean multi-candidate score by label; a drift with position would show here
+    by_position = {}
+    for r in multi_rows.rows:
+        if r.get("judge_mode") == "multi":
+            by_position.setdefault(r["candidate"], []).append(r["score"])
+
+    return {
+        "examples": len(records),
+        "overall": score_agreement(single, multi),
+        "by_method": by_method,
+        "multi_mean_by_position": {label: float(np.mean(v)) for label, v in sorted(by_position.items())},
+        "multi_fallback_candidates": fallbacks,
+        "cost": {
+            "single": prompt_cost(list(groups)),
+            "multi": prompt_cost([messages for messages, _, _ in slates]),
+        },
+        "prompt_layout": layout,
+        "timestamp": datetime.now().isoformat(),
+    }
+
+
+def pair_hash(gold, rewrite):
+    return hashlib.blake2b(f"{gold}\0{rewrite}".encode("utf-8"), digest_size=8).hexdigest()
+
+
+def compute_metrics(records, previous=None):
+    import pandas as pd
+    from rouge_score import tokenizers
+
+    store = EmbeddingStore(SBERT_MODEL)
+    model = None
 
-        for i, (gold, hyp) in enumerate(zip(golds, hyps)):
-            bleu1 = sentence_bleu(gold, hyp)
-            rouge = scorer.score(gold, hyp)["rougeL"].fmeasure
-            sim = float((gold_embs[i] @ hyp_embs[i]).cpu())
+    def encode(texts):
+        # torch and the model are only loaded when some text is missing from the store
+        nonlocal model
+        import torch
 
-            metrics["method"].append(method)
-            metrics["bleu1"].append(bleu1)
-            metrics["rougeL"].append(rouge)
-            metrics["sbert_cosine"].append(sim)
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        if model is None:
+            from sentence_transformers import SentenceTransformer
+
+            model = SentenceTransformer(SBERT_MODEL, device=device)
+        batch_size = 64 if device == "cuda" else 16
+        return model.encode(texts, batch_size=batch_size, convert_to_numpy=True, normalize_embeddings=True)
+
+    # Method-major rows, same order as before; the hash ties a row to the exact
+    # gold/rewrite pair it was scored on, so edited or rerun outputs are rescored
+    rows = [(method, r) for method in available_methods(records) for r in records]
+    pairs = [(r["gold_rewrite"], r["outputs"][method]["rewrite"]) for method, r in rows]
+    df = pd.DataFrame(
+        [(r["example_id"], method, pair_hash(*pair)) for (method, r), pair in zip(rows, pairs)],
+        columns=ROW_KEYS,
+    )
+    if previous is not None and len(previous):
+        df = df.merge(previous[ROW_KEYS + METRIC_COLUMNS].drop_duplicates(ROW_KEYS), on=ROW_KEYS, how="left")
+    else:
+        df = df.assign(**{col: np.nan for col in METRIC_COLUMNS})
+
+    todo = np.flatnonzero(df[METRIC_COLUMNS].isna().any(axis=1).to_numpy())
+    print(f"Scoring {len(todo)} new or changed rows, reusing {len(df) - len(todo)}")
+    if len(todo):
+        golds = [pairs[i][0] for i in todo]
+        hyps = [pairs[i][1] for i in todo]
+
+        # Token ids are shared across methods; identical strings are tokenized once
+        bleu_vocab = Interner(bleu_tokenize)
+        rouge_vocab = Interner(tokenizers.DefaultTokenizer(use_stemmer=True).tokenize)
+        gold_bleu = bleu_vocab.encode_all(golds)
+        hyp_bleu = bleu_vocab.encode_all(hyps)
+
+        df.loc[todo, "bleu1"] = bleu1_scores(gold_bleu, hyp_bleu, len(bleu_vocab))
+        df.loc[todo, "rougeL"] = rougeL_scores(rouge_vocab.encode_all(golds), rouge_vocab.encode_all(hyps))
+        df.loc[todo, "sbert_cosine"] = rowwise_cosine(store.embed(golds, encode), store.embed(hyps, encode))
+        print(f"SBERT embedding store: {store.stats()}")
 
-    df = pd.DataFrame(metrics)
     return df
 
 
-def summary_stats(df, judgments, judgments_ids):
-    summary = {}
-    for method in METHODS:
-        subset = df[df["method"] == method]
-        scores = [judgments.get((ex_id, method), {}).get("score")
-                  for ex_id in judgments_ids]
-        scores = [s for s in scores if s is not None]
+def clarification_used(rec, method):
+    if method == "gated_clarify":
+        return float(bool(rec["outputs"]["gated_clarify"].get("used_clarification", False)))
+    return 1.0 if method == "always_clarify" else 0.0
 
+
+def empty_aggregator():
+    return OnlineAggregator(PAIRED_METHODS, METRIC_COLUMNS + ["judge"])
+
+
+def aggregate(records, df, judgments, agg=None):
+    # Fed one example at a time, so the same state can be built while outputs
+    # stream in and merged across shards (see online_stats). Given a saved state,
+    # only examples it has not seen are folded in, and only once every scored
+    # method has its judgment; returns (agg, examples held back).
+    incremental = agg is not None
+    if agg is None:
+        agg = empty_aggregator()
+    records = [r for r in records if r["example_id"] not in agg.example_ids]
+    df = df[df["example_id"].isin({r["example_id"] for r in records})]
+    scores = {(row.example_id, row.method): row for row in df.itertuples(index=False)}
+    methods = [m for m in METHODS if m in set(df["method"])]
+    held_back = 0
+    for rec in records:
+        values = {}
+        for method in methods:
+            row = scores.get((rec["example_id"], method))
+            if row is None:
+                continue
+            values[method] = {
+                "bleu1": row.bleu1,
+                "rougeL": row.rougeL,
+                "sbert_cosine": row.sbert_cosine,
+                "judge": judgments.get((rec["example_id"], method), {}).get("score"),
+                "clarification": clarification_used(rec, method),
+            }
+        if not values:
+            continue
+        if incremental and any((rec["example_id"], method) not in judgments for method in values):
+            held_back += 1
+            continue
+        agg.add_example(values, rec["example_id"])
+    return agg, held_back
+
+
+def summary_stats(agg):
+    summary = {}
+    for method in [m for m in METHODS if m in agg.methods()]:
+        judge = agg.get(method, "judge")
         summary[method] = {
-            "bleu1_mean": float(subset["bleu1"].mean()),
-            "bleu1_std": float(subset["bleu1"].std()),
-            "rougeL_mean": float(subset["rougeL"].mean()),
-            "rougeL_std": float(subset["rougeL"].std()),
-            "sbert_mean": float(subset["sbert_cosine"].mean()),
-            "sbert_std": float(subset["sbert_cosine"].std()),
-            "judge_mean": float(np.mean(scores)) if scores else None,
-            "judge_std": float(np.std(scores)) if scores else None,
+            "bleu1_mean": agg.get(method, "bleu1").mean,
+            "bleu1_std": agg.get(method, "bleu1").std(ddof=1),
+            "rougeL_mean": agg.get(method, "rougeL").mean,
+            "rougeL_std": agg.get(method, "rougeL").std(ddof=1),
+            "sbert_mean": agg.get(method, "sbert_cosine").mean,
+            "sbert_std": agg.get(method, "sbert_cosine").std(ddof=1),
+            "judge_mean": judge.mean if judge.n else None,
+            "judge_std": judge.std() if judge.n else None,
         }
     return summary
 
 
-def compute_stats(df, judgments, judgments_ids):
-    results = {}
+def compute_stats(agg):
     # Paired tests: direct_rewrite vs gated_clarify
-    for metric in ["bleu1", "rougeL", "sbert_cosine"]:
-        a = df[df["method"] == "direct_rewrite"][metric].values
-        b = df[df["method"] == "gated_clarify"][metric].values
-        t_stat, p_val = stats.ttest_rel(b, a)
-        d = (b.mean() - a.mean()) / (np.std(b - a) + 1e-9)
+    results = {}
+    for metric in METRIC_COLUMNS:
+        diff = agg.diff(metric)
+        if diff.n == 0:
+            continue
+        t_stat, p_val = paired_ttest(diff)
         results[metric] = {
             "t_stat": float(t_stat),
             "p_val": float(p_val),
-            "cohens_d": float(d),
+            "cohens_d": float(diff.mean / (diff.std() + 1e-9)),
         }
 
-    # Judge scores
-    judge_pairs = []
-    for ex_id in judgments_ids:
-        s_a = judgments.get((ex_id, "direct_rewrite"), {}).get("score")
-        s_b = judgments.get((ex_id, "gated_clarify"), {}).get("score")
-        if s_a is not None and s_b is not None:
-            judge_pairs.append((s_a, s_b))
-
-    if judge_pairs:
-        a = np.array([p[0] for p in judge_pairs])
-        b = np.array([p[1] for p in judge_pairs])
-        t_stat, p_val = stats.ttest_rel(b, a)
-        d = (b.mean() - a.mean()) / (np.std(b - a) + 1e-9)
+    # Judge scores, over examples where both methods were judged
+    diff = agg.diff("judge")
+    if diff.n:
+        t_stat, p_val = paired_ttest(diff)
         results["judge_score"] = {
             "t_stat": float(t_stat),
             "p_val": float(p_val),
-            "cohens_d": float(d),
-            "n": int(len(judge_pairs)),
+            "cohens_d": float(diff.mean / (diff.std() + 1e-9)),
+            "n": int(diff.n),
         }
 
     return results
 
 
+def score_matrix(records, df, judgments, methods):
+    # (metric, method, example) array for resampling; NaN marks a missing score
+    index = {r["example_id"]: i for i, r in enumerate(records)}
+    pos = {m: j for j, m in enumerate(methods)}
+    values = np.full((len(METRIC_COLUMNS) + 1, len(methods), len(records)), np.nan)
+    rows = df[df["method"].isin(pos) & df["example_id"].isin(index)]
+    ii = rows["example_id"].map(index).to_numpy()
+    jj = rows["method"].map(pos).to_numpy()
+    for k, metric in enumerate(METRIC_COLUMNS):
+        values[k, jj, ii] = rows[metric].to_numpy()
+    for (example_id, method), obj in judgments.items():
+        if method in pos and example_id in index and obj.get("score") is not None:
+            values[-1, pos[method], index[example_id]] = obj["score"]
+    return values
+
+
+def resampling_stats(records, df, judgments, n_resamples, seed):
+    methods = [m for m in METHODS if m in set(df["method"])]
+    values = score_matrix(records, df, judgments, methods)
+    return {
+        "n_resamples": n_resamples,
+        "seed": seed,
+        "confidence": 0.95,
+        "pairs": pairwise_resampling(values, methods, METRIC_COLUMNS + ["judge_score"], n_resamples, seed),
+    }
+
+
+def clarification_rate(agg):
+    methods = agg.methods()
+    return {m: agg.get(m, "clarification").mean for m in CLARIFICATION_ORDER if m in methods}
+
+
 def plot_metrics(df):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     sns.set(style="whitegrid")
     fig, axes = plt.subplots(1, 3, figsize=(14, 4))
 
@@ -217,41 +665,187 @@ def plot_metrics(df):
     fig.savefig(PLOT_PATH, dpi=150)
 
 
-def main():
+def save_rows(df):
+    # Readers (stats, plot, dashboards) never see a half-written table
+    os.makedirs(os.path.dirname(ROWS_PATH), exist_ok=True)
+    tmp_path = ROWS_PATH + ".tmp"
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, ROWS_PATH)
+    print("Wrote:", ROWS_PATH)
+
+
+def load_rows(required=True, path=ROWS_PATH):
+    import pandas as pd
+
+    if not os.path.exists(path):
+        if not required:
+            return None
+        raise SystemExit(f"{path} not found; run `analyze_results.py metrics` first")
+    return pd.read_parquet(path)
+
+
+def cmd_judge(args):
     records = load_outputs()
+    if args.batch:
+        from batch_utils import get_batch_backend
 
-    # Use a deterministic list of example IDs for judging
-    judgments_ids = [r["example_id"] for r in records]
+        run_judging_batch(records, get_batch_backend(args.batch), args.prompt_layout, args.judge_mode)
+    else:
+        run_judging(records, args.concurrency, args.max_concurrency, args.prompt_layout, args.judge_mode)
 
-    run_judging(records)
-    judgments = load_judgments()
 
-    df = compute_metrics(records)
-    summary = summary_stats(df, judgments, judgments_ids)
-    stats_results = compute_stats(df, judgments, judgments_ids)
+def cmd_agreement(args):
+    records = load_outputs()
+    if 0 < args.sample < len(records):
+        records = random.Random(args.seed).sample(records, args.sample)
+    report = judge_agreement(records, args.concurrency, args.max_concurrency, args.prompt_layout)
+    overall = report["overall"]
+    print(f"Single vs multi-candidate judge on {overall['n']} judgments: "
+          f"exact {overall.get('exact', 0):.1%}, within one {overall.get('within_one', 0):.1%}")
+    print(f"Requests {report['cost']['single']['requests']} -> {report['cost']['multi']['requests']}, "
+          f"est. prompt tokens {report['cost']['single']['est_prompt_tokens']} -> "
+          f"{report['cost']['multi']['est_prompt_tokens']}")
+    os.makedirs(os.path.dirname(AGREEMENT_PATH), exist_ok=True)
+    with open(AGREEMENT_PATH, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Wrote:", AGREEMENT_PATH)
+
+
+def cmd_metrics(args):
+    previous = None if args.full else load_rows(required=False)
+    df = compute_metrics(load_outputs(), previous)
+    save_rows(df)
+    return df
 
-    clar_rate = {
-        "always_clarify": 1.0,
-        "gated_clarify": float(np.mean([r["outputs"]["gated_clarify"].get("used_clarification", False) for r in records])),
-        "direct_rewrite": 0.0,
-        "no_rewrite": 0.0,
-    }
+
+def cmd_stats(args, df=None):
+    if args.merge_state and args.incremental:
+        raise SystemExit("--merge-state and --incremental cannot be combined")
+    if args.merge_state:
+        # Shard or live-run states saved with --save-state; no tables are reloaded
+        agg = OnlineAggregator.load(args.merge_state[0])
+        for path in args.merge_state[1:]:
+            agg.merge(OnlineAggregator.load(path))
+    else:
+        records = load_outputs(args.outputs)
+        if df is None:
+            df = load_rows(path=args.rows)
+        judgments = load_judgments(args.judgments, records)
+        previous = None
+        if args.incremental:
+            exists = os.path.exists(args.incremental)
+            previous = OnlineAggregator.load(args.incremental) if exists else empty_aggregator()
+        seen = len(previous.example_ids) if previous is not None else 0
+        agg, held_back = aggregate(records, df, judgments, previous)
+        if args.incremental:
+            print(f"Folded {len(agg.example_ids) - seen} new examples into {seen}"
+                  + (f"; {held_back} wait for judgments" if held_back else ""))
+            agg.save(args.incremental)
+            print("Wrote:", args.incremental)
+    if args.save_state:
+        agg.save(args.save_state)
+        print("Wrote:", args.save_state)
 
     output = {
-        "summary": summary,
-        "pairwise_stats": stats_results,
-        "clarification_rate": clar_rate,
+        "summary": summary_stats(agg),
+        "pairwise_stats": compute_stats(agg),
+        "clarification_rate": clarification_rate(agg),
         "timestamp": datetime.now().isoformat(),
     }
+    # Resampling needs per-example scores, which merged and incremental states do not carry
+    if args.resamples > 0 and not args.merge_state and not args.incremental:
+        output["resampling"] = resampling_stats(records, df, judgments, args.resamples, args.seed)
 
-    with open(METRICS_PATH, "w") as f:
+    with open(args.metrics_out, "w") as f:
         json.dump(output, f, indent=2)
+    print("Wrote:", args.metrics_out)
 
-    plot_metrics(df)
 
-    print("Wrote:", METRICS_PATH)
+def cmd_plot(args, df=None):
+    plot_metrics(load_rows() if df is None else df)
     print("Wrote:", PLOT_PATH)
 
 
+def cmd_all(args):
+    cmd_judge(args)
+    df = cmd_metrics(args)
+    cmd_stats(args, df)
+    cmd_plot(args, df)
+
+
+def parse_args(argv=None):
+    client_opts = argparse.ArgumentParser(add_help=False)
+    client_opts.add_argument("--concurrency", type=int, default=JUDGE_CONCURRENCY,
+                             help="initial number of judge requests in flight")
+    client_opts.add_argument("--max-concurrency", type=int, default=JUDGE_MAX_CONCURRENCY,
+                             help="upper bound for adaptive judge concurrency")
+    client_opts.add_argument("--prompt-layout", choices=PROMPT_LAYOUTS, default=PROMPT_LAYOUT,
+                             help="'shared' puts the conversation before the judge instructions for prefix caching")
+    judge_opts = argparse.ArgumentParser(add_help=False, parents=[client_opts])
+    judge_opts.add_argument("--batch", choices=["openai", "local"],
+                            help="submit pending judge requests through a batch backend")
+    judge_opts.add_argument("--judge-mode", choices=JUDGE_MODES, default=JUDGE_MODE,
+                            help="'multi' scores all candidates of an example in one shuffled, anonymized request")
+    metrics_opts = argparse.ArgumentParser(add_help=False)
+    metrics_opts.add_argument("--full", action="store_true",
+                              help="rescore every row instead of only new or changed outputs")
+
+    stats_opts = argparse.ArgumentParser(add_help=False)
+    stats_opts.add_argument("--save-state", metavar="PATH",
+                            help="also write the mergeable aggregator state as JSON")
+    stats_opts.add_argument("--merge-state", nargs="+", metavar="PATH",
+                            help="build metrics.json by merging saved states instead of reading the tables")
+    stats_opts.add_argument("--resamples", type=int, default=BOOTSTRAP_RESAMPLES,
+                            help="bootstrap/permutation resamples for all method pairs (0 disables)")
+    stats_opts.add_argument("--seed", type=int, default=42, help="seed for the resampling")
+
+    parser = argparse.ArgumentParser(description="Judge outputs, compute metrics and plot")
+    sub = parser.add_subparsers(dest="command")
+    pipeline = sub.add_parser("all", parents=[judge_opts, metrics_opts, stats_opts],
+                              help="judge, metrics, stats and plot (default)")
+    # The whole pipeline always works on the default files
+    pipeline.set_defaults(outputs=OUTPUT_PATH, judgments=JUDGE_PATH, rows=ROWS_PATH,
+                          metrics_out=METRICS_PATH, incremental=None)
+    sub.add_parser("judge", parents=[judge_opts], help="run the LLM judge on pending outputs")
+    sub.add_parser("metrics", parents=[metrics_opts],
+                   help=f"score new or changed outputs into {os.path.relpath(ROWS_PATH, ROOT)}")
+    stats = sub.add_parser("stats", parents=[stats_opts],
+                           help="summaries and paired tests from stored metrics and judgments")
+    stats.add_argument("--outputs", default=OUTPUT_PATH, metavar="PATH",
+                       help="model outputs to aggregate, e.g. one shard's llm_outputs.shard-i-of-N.jsonl")
+    stats.add_argument("--judgments", default=JUDGE_PATH, metavar="PATH", help="judgments to aggregate")
+    stats.add_argument("--rows", default=ROWS_PATH, metavar="PATH", help="per-example metrics table")
+    stats.add_argument("--metrics-out", default=METRICS_PATH, metavar="PATH", help="where to write metrics.json")
+    stats.add_argument("--incremental", metavar="STATE",
+                       help="load STATE (if present), fold in only examples it has not seen and save it back; "
+                            "skips resampling")
+    sub.add_parser("plot", help="plot stored per-example metrics")
+    agreement = sub.add_parser("agreement", parents=[client_opts],
+                               help="compare single- and multi-candidate judge scores on a sample of outputs")
+    agreement.add_argument("--sample", type=int, default=100, help="examples to judge both ways (0 = all)")
+    agreement.add_argument("--seed", type=int, default=42, help="seed for the example sample")
+
+    argv = sys.argv[1:] if argv is None else list(argv)
+    # Bare invocations (optionally with judge flags) keep running the whole pipeline
+    if not argv or (argv[0].startswith("-") and argv[0] not in ("-h", "--help")):
+        argv = ["all"] + argv
+    return parser.parse_args(argv)
+
+
+COMMANDS = {
+    "all": cmd_all,
+    "judge": cmd_judge,
+    "metrics": cmd_metrics,
+    "stats": cmd_stats,
+    "plot": cmd_plot,
+    "agreement": cmd_agreement,
+}
+
+
+def main():
+    args = parse_args()
+    COMMANDS[args.command](args)
+
+
 if __name__ == "__main__":
     main()
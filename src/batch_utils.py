@@ -0,0 +1,222 @@
+import hashlib
+import json
+import os
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from llm_cache import ResponseCache, shared_response_cache
+from llm_utils import LLMConfig, client_kwargs, request_key, request_kwargs
+from structured_output import parse_json
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+BATCH_DIR = os.getenv("BATCH_DIR", os.path.join(ROOT, ".cache", "batches"))
+BATCH_POLL_S = float(os.getenv("BATCH_POLL_S", "30"))
+# OpenAI caps a single batch input file at 50k requests
+BATCH_MAX_REQUESTS = 50000
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+# (custom_id, system, user, config)
+BatchRequest = Tuple[str, str, str, LLMConfig]
+
+
+def batch_line(custom_id: str, system: str, user: str, cfg: LLMConfig) -> Dict[str, Any]:
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": request_kwargs(system, user, cfg),
+    }
+
+
+def write_jsonl(path: str, rows: Iterable[Dict[str, Any]]) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+
+def read_batch_output(path: str) -> Dict[str, Dict[str, Any]]:
+    results = {}
+    with open(path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            obj = json.loads(line)
+            response = obj.get("response") or {}
+            if obj.get("error") or response.get("status_code") != 200:
+                continue
+            body = response["body"]
+            results[obj["custom_id"]] = {
+                "content": body["choices"][0]["message"]["content"],
+                "usage": body.get("usage") or {},
+            }
+    return results
+
+
+class BatchFailed(RuntimeError):
+    """The batch reached a terminal failed state; resubmitting is the only way forward."""
+
+
+def batch_scope(output_path: str) -> str:
+    # Batch files are named after the output they feed, so concurrent runs (e.g.
+    # --shard workers) writing different outputs never share input/state files
+    stem = os.path.splitext(os.path.basename(output_path))[0]
+    digest = hashlib.blake2b(os.path.abspath(output_path).encode("utf-8"), digest_size=4).hexdigest()
+    return f"{stem}-{digest}"
+
+
+class OpenAIBatchBackend:
+    def __init__(self, poll_interval: float = BATCH_POLL_S):
+        from openai import OpenAI
+
+        self.client = OpenAI(**client_kwargs())
+        self.poll_interval = poll_interval
+
+    def submit(self, input_path: str) -> str:
+        with open(input_path, "rb") as f:
+            uploaded = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=uploaded.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window="24h",
+        )
+        return batch.id
+
+    def wait(self, batch_id: str, output_path: str) -> None:
+        while True:
+            batch = self.client.batches.retrieve(batch_id)
+            if batch.status in ("completed", "failed", "expired", "cancelled"):
+                break
+            counts = batch.request_counts
+            done = f"{counts.completed}/{counts.total}" if counts else "?"
+            print(f"Batch {batch_id}: {batch.status} ({done})")
+            time.sleep(self.poll_interval)
+        if batch.status == "failed":
+            raise BatchFailed(f"Batch {batch_id} failed: {batch.errors}")
+        # Expired/cancelled batches still return whatever finished
+        text = self.client.files.content(batch.output_file_id).text if batch.output_file_id else ""
+        with open(output_path, "w") as f:
+            f.write(text)
+
+
+class LocalBatchBackend:
+    # File-based stand-in that answers every request with the stub server's
+    # canned completions; lets the batch path run without network access
+    def submit(self, input_path: str) -> str:
+        return input_path
+
+    def wait(self, batch_id: str, output_path: str) -> None:
+        from stub_server import completion
+
+        with open(batch_id, "r") as f_in, open(output_path, "w") as f_out:
+            for i, line in enumerate(f_in):
+                req = json.loads(line)
+                row = {
+                    "id": f"batch_req_{i}",
+                    "custom_id": req["custom_id"],
+                    "response": {"status_code": 200, "request_id": f"req_{i}", "body": completion(req["body"])},
+                    "error": None,
+                }
+                f_out.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+
+def get_batch_backend(name: str):
+    if name == "openai":
+        return OpenAIBatchBackend()
+    if name == "local":
+        return LocalBatchBackend()
+    raise ValueError(f"Unknown batch backend: {name}")
+
+
+def _file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _submit_or_resume(backend, input_path: str, state_path: str) -> str:
+    # A crash while polling would otherwise lose the batch id and pay for it twice.
+    # The state file only exists while a batch is in flight (see _forget_batch).
+    input_sha = _file_sha256(input_path)
+    if os.path.exists(state_path):
+        with open(state_path, "r") as f:
+            state = json.load(f)
+        if state.get("input_sha256") == input_sha:
+            return state["batch_id"]
+    batch_id = backend.submit(input_path)
+    with open(state_path, "w") as f:
+        json.dump({"batch_id": batch_id, "input_sha256": input_sha}, f)
+    return batch_id
+
+
+def _forget_batch(state_path: str) -> None:
+    # Called once a batch is terminal, so the next run submits afresh instead of
+    # resuming a failed or expired batch id
+    if os.path.exists(state_path):
+        os.remove(state_path)
+
+
+def run_batch(requests: List[BatchRequest], backend, name: str,
+              cache: Optional[ResponseCache] = None) -> Dict[str, Dict[str, Any]]:
+    """Run chat_json-style requests through the batch backend.
+
+    Returns ``{custom_id: {"data", "usage", "duration_s", "cached"}}``. Requests
+    already in the response cache are served locally; requests that errored,
+    returned no recoverable JSON object or missed a required key are left out so
+    the caller treats them as pending.
+    """
+    cache = cache or shared_response_cache()
+    results = {}
+    keys = {}
+    schemas = {}
+    lines = []
+    for custom_id, system, user, cfg in requests:
+        key = request_key(system, user, cfg)
+        hit = cache.get(key)
+        if hit is not None:
+            try:
+                data = parse_json(hit["content"], cfg.schema)[0]
+            except ValueError:
+                # Cached before required keys were checked; ask again
+                data = None
+            if data is not None:
+                results[custom_id] = {"data": data, "usage": hit["usage"], "duration_s": 0.0, "cached": True}
+                continue
+        keys[custom_id] = key
+        schemas[custom_id] = cfg.schema
+        lines.append(batch_line(custom_id, system, user, cfg))
+
+    failed = 0
+    for start in range(0, len(lines), BATCH_MAX_REQUESTS):
+        stem = os.path.join(BATCH_DIR, f"{name}-{start // BATCH_MAX_REQUESTS:03d}")
+        write_jsonl(stem + ".input.jsonl", lines[start:start + BATCH_MAX_REQUESTS])
+        state_path = stem + ".state.json"
+        batch_id = _submit_or_resume(backend, stem + ".input.jsonl", state_path)
+        try:
+            backend.wait(batch_id, stem + ".output.jsonl")
+        except BatchFailed:
+            _forget_batch(state_path)
+            raise
+        chunk_ids = [line["custom_id"] for line in lines[start:start + BATCH_MAX_REQUESTS]]
+        outputs = read_batch_output(stem + ".output.jsonl")
+        for custom_id in chunk_ids:
+            out = outputs.get(custom_id)
+            try:
+                data = parse_json(out["content"], schemas[custom_id])[0] if out else None
+            except ValueError:
+                data = None
+            if data is None:
+                failed += 1
+                continue
+            cache.put(keys[custom_id], {"content": out["content"], "usage": out["usage"]})
+            # Batch requests have no meaningful per-request latency
+            results[custom_id] = {"data": data, "usage": out["usage"], "duration_s": None, "cached": False}
+        # Completed, expired and cancelled batches are done; what they returned is cached,
+        # and anything missing is resubmitted as a new batch on the next run
+        _forget_batch(state_path)
+
+    if lines or failed:
+        print(f"Batch {name}: {len(lines)} submitted, {len(requests) - len(lines)} cached, {failed} failed")
+    return results
@@ -0,0 +1,66 @@
+import argparse
+import os
+import subprocess
+import sys
+
+SRC = os.path.dirname(os.path.abspath(__file__))
+
+MODULES = ["analyze_results", "data_prep", "run_experiments"]
+
+
+def import_profile(module):
+    # -X importtime reports "self | cumulative | name" in microseconds on stderr
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=SRC, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{proc.stderr.strip().splitlines()[-1]}")
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        name = name[1:]
+        # Nesting is shown as two spaces per level below the imported module
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((name.strip(), depth, int(self_us), int(cumulative_us)))
+    return rows
+
+
+def summarize(module, repeat):
+    best = None
+    for _ in range(max(repeat, 1)):
+        rows = import_profile(module)
+        total = next(cum for name, depth, _, cum in rows if name == module and depth == 0)
+        if best is None or total < best[0]:
+            best = (total, rows)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure cold import time of the pipeline scripts")
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    parser.add_argument("--repeat", type=int, default=3, help="report the fastest of N fresh interpreters")
+    parser.add_argument("--top", type=int, default=5, help="heaviest top-level imports to list per module")
+    parser.add_argument("--budget-ms", type=float, default=None,
+                        help="exit non-zero if any module takes longer than this to import")
+    args = parser.parse_args()
+
+    over = []
+    for module in args.modules:
+        total_us, rows = summarize(module, args.repeat)
+        print(f"{module}: {total_us / 1000:.0f} ms")
+        direct = [(name, cum) for name, depth, _, cum in rows if depth == 1]
+        for name, cum in sorted(direct, key=lambda x: -x[1])[:args.top]:
+            print(f"  {cum / 1000:8.1f} ms  {name}")
+        if args.budget_ms is not None and total_us / 1000 > args.budget_ms:
+            over.append(module)
+
+    if over:
+        print(f"Over the {args.budget_ms:.0f} ms budget: {', '.join(over)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+import os
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from rate_limit import CHARS_PER_TOKEN
+
+# Applied while the formatted context is over the budget, in order:
+#   truncate_answers - cut older assistant answers to answer_tokens
+#   user_turns       - drop older assistant answers, keeping every user turn
+#   last_turns       - drop the oldest turns
+CONTEXT_STRATEGIES = {
+    "last_turns": ("last_turns",),
+    "truncate_answers": ("truncate_answers", "last_turns"),
+    "user_turns": ("user_turns", "last_turns"),
+    "auto": ("truncate_answers", "user_turns", "last_turns"),
+}
+CONTEXT_BUDGET = int(os.getenv("CONTEXT_BUDGET", "0"))
+CONTEXT_STRATEGY = os.getenv("CONTEXT_STRATEGY", "auto")
+CONTEXT_TURNS = int(os.getenv("CONTEXT_TURNS", "0"))
+CONTEXT_ANSWER_TOKENS = int(os.getenv("CONTEXT_ANSWER_TOKENS", "64"))
+CONTEXT_ENCODING = os.getenv("CONTEXT_ENCODING", "o200k_base")
+
+NO_CONTEXT = "(no prior context)"
+ELLIPSIS = " ..."
+
+
+class LocalTokenizer:
+    """tiktoken when its encoding is available locally, else the rate limiter's chars/token estimate."""
+
+    def __init__(self, encoding: str = CONTEXT_ENCODING):
+        self.encoding = None
+        try:
+            import tiktoken
+
+            self.encoding = tiktoken.get_encoding(encoding)
+            self.name = encoding
+        except Exception:  # not installed, or the BPE file cannot be fetched offline
+            self.name = f"chars/{CHARS_PER_TOKEN}"
+
+    def count(self, text: str) -> int:
+        if self.encoding is not None:
+            return len(self.encoding.encode(text, disallowed_special=()))
+        return -(-len(text) // CHARS_PER_TOKEN)
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        if self.encoding is not None:
+            ids = self.encoding.encode(text, disallowed_special=())
+            return text if len(ids) <= max_tokens else self.encoding.decode(ids[:max_tokens]) + ELLIPSIS
+        limit = max_tokens * CHARS_PER_TOKEN
+        return text if len(text) <= limit else text[:limit] + ELLIPSIS
+
+
+_TOKENIZERS: Dict[str, LocalTokenizer] = {}
+
+
+def local_tokenizer(encoding: str = CONTEXT_ENCODING) -> LocalTokenizer:
+    # Loading an encoding is slow, so each process builds one per name
+    if encoding not in _TOKENIZERS:
+        _TOKENIZERS[encoding] = LocalTokenizer(encoding)
+    return _TOKENIZERS[encoding]
+
+
+def context_turns(context_list) -> List[Tuple[str, str]]:
+    # QReCC context is alternating Q/A strings, starting with the user
+    return [("User" if i % 2 == 0 else "Assistant", text) for i, text in enumerate(context_list or [])]
+
+
+def render_turns(turns) -> str:
+    if not turns:
+        return NO_CONTEXT
+    return "\n".join(f"{role}: {text}" for role, text in turns)
+
+
+@dataclass
+class ContextBudget:
+    max_tokens: int = CONTEXT_BUDGET  # 0 keeps the whole conversation
+    strategy: str = CONTEXT_STRATEGY
+    keep_turns: int = CONTEXT_TURNS  # 0 keeps every turn
+    answer_tokens: int = CONTEXT_ANSWER_TOKENS
+    encoding: str = CONTEXT_ENCODING
+
+    def __post_init__(self):
+        if self.strategy not in CONTEXT_STRATEGIES:
+            raise ValueError(f"Unknown context strategy {self.strategy!r}; expected one of {sorted(CONTEXT_STRATEGIES)}")
+
+    @property
+    def active(self) -> bool:
+        return self.max_tokens > 0 or self.keep_turns > 0
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "max_tokens": self.max_tokens,
+            "strategy": self.strategy,
+            "keep_turns": self.keep_turns,
+            "answer_tokens": self.answer_tokens,
+            "tokenizer": local_tokenizer(self.encoding).name if self.active else None,
+        }
+
+    def apply(self, context_list) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """Format the conversation within the budget; returns (text, metadata or None)."""
+        turns = context_turns(context_list)
+        if not self.active:
+            return render_turns(turns), None
+        tok = local_tokenizer(self.encoding)
+        sizes = [tok.count(f"{role}: {text}") + 1 for role, text in turns]
+        tokens_before = sum(sizes)
+        steps = []
+
+        def over():
+            return self.max_tokens > 0 and sum(sizes) > self.max_tokens
+
+        if 0 < self.keep_turns < len(turns):
+            turns, sizes = turns[-self.keep_turns:], sizes[-self.keep_turns:]
+            steps.append("keep_turns")
+        # The latest turns carry the referents the question most likely points at,
+        # so every step works from the oldest turn forward and spares the last one
+        for step in CONTEXT_STRATEGIES[self.strategy]:
+            if not over():
+                break
+            changed = False
+            for i in range(len(turns) - 1):
+                if not over():
+                    break
+                role, text = turns[i]
+                if step == "last_turns" or (step == "user_turns" and role == "Assistant"):
+                    turns[i], sizes[i] = None, 0
+                    changed = True
+                elif step == "truncate_answers" and role == "Assistant":
+                    short = tok.truncate(text, self.answer_tokens)
+                    if short != text:
+                        turns[i], sizes[i] = (role, short), tok.count(f"{role}: {short}") + 1
+                        changed = True
+            if changed:
+                steps.append(step)
+                kept = [i for i, turn in enumerate(turns) if turn is not None]
+                turns, sizes = [turns[i] for i in kept], [sizes[i] for i in kept]
+        if over() and turns:
+            # A single turn longer than the whole budget is cut to fit
+            role, text = turns[-1]
+            short = tok.truncate(text, max(self.max_tokens - 8, 1))
+            turns[-1], sizes[-1] = (role, short), tok.count(f"{role}: {short}") + 1
+            steps.append("truncate_last")
+
+        return render_turns(turns), {
+            "strategy": self.strategy,
+            "steps": steps,
+            "tokens": sum(sizes),
+            "tokens_before": tokens_before,
+            "turns": len(turns),
+            "turns_before": len(context_list or []),
+        }
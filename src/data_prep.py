@@ -1,13 +1,15 @@
+import argparse
 import json
 import os
 import random
 import re
-from collections import Counter
+from array import array
 from datetime import datetime
 
-import matplotlib.pyplot as plt
 import numpy as np
 
+from token_store import TOKEN_STORE_DIR, TokenStoreBuilder, example_key, load_token_store, source_fingerprint
+
 ROOT = os.path.dirname(os.path.dirname(__file__))
 DATA_PATH = os.path.join(ROOT, "datasets", "qrecc", "qrecc-test.json")
 OUTPUT_SAMPLE = os.path.join(ROOT, "results", "sample.jsonl")
@@ -16,6 +18,9 @@ PLOT_PATH = os.path.join(ROOT, "results", "plots", "data_distributions.png")
 
 SEED = 42
 SAMPLE_SIZE = 120
+CHUNK_SIZE = 1 << 20
+# Lower edges of the strata buckets used by --sample-mode stratified
+STRATA_EDGES = (1, 2, 3, 4, 6, 9)
 
 
 def set_seed(seed: int = 42) -> None:
@@ -31,64 +36,198 @@ def tokenize(text: str):
     return re.findall(r"\w+|[^\w\s]", text.lower())
 
 
-def main():
-    set_seed(SEED)
+def iter_json_array(path, chunk_size=CHUNK_SIZE):
+    # Yields the elements of a top-level JSON array one at a time, keeping only
+    # the current chunk and the element being decoded in memory
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        buf = f.read(chunk_size).lstrip()
+        if not buf.startswith("["):
+            raise ValueError(f"{path} is not a JSON array")
+        pos = 1
+        eof = False
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buf) and buf[pos] == "]":
+                return
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                more = f.read(chunk_size)
+                eof = not more
+                buf = buf[pos:] + more
+                pos = 0
+                continue
+            yield obj
+            pos = end
+
+
+class LengthStats:
+    # Lengths are kept as a compact uint32 column (4 bytes per example) so the
+    # mean/std match np.mean/np.std over the full list bit for bit
+    def __init__(self):
+        self.values = array("I")
+
+    def add(self, length):
+        self.values.append(length)
+
+
+class ReservoirSampler:
+    # Algorithm R: a uniform sample of fixed size from a stream of unknown length
+    def __init__(self, size, rng):
+        self.size = size
+        self.rng = rng
+        self.seen = 0
+        self.items = []
+
+    def add(self, item):
+        self.seen += 1
+        if len(self.items) < self.size:
+            self.items.append(item)
+            return
+        j = self.rng.randrange(self.seen)
+        if j < self.size:
+            self.items[j] = item
+
+    def result(self):
+        return list(self.items)
+
+
+def bucket_label(value, edges=STRATA_EDGES):
+    lower = [e for e in edges if e <= value]
+    if not lower:
+        return f"<{edges[0]}"
+    i = edges.index(lower[-1])
+    if i + 1 < len(edges) and edges[i + 1] - edges[i] == 1:
+        return str(edges[i])
+    if i + 1 < len(edges):
+        return f"{edges[i]}-{edges[i + 1] - 1}"
+    return f"{edges[i]}+"
+
 
-    with open(DATA_PATH, "r") as f:
-        data = json.load(f)
+def stratum_of(d, strata):
+    if strata == "turn":
+        return bucket_label(int(d.get("Turn_no") or 0))
+    # Prior exchanges (user question + answer) in the conversation context
+    return bucket_label(safe_len(d.get("Context")) // 2)
 
-    total = len(data)
-    with_context = [d for d in data if d.get("Context")]
-    no_context = total - len(with_context)
 
-    q_lens = [len(tokenize(d.get("Question", ""))) for d in data]
-    r_lens = [len(tokenize(d.get("Rewrite", ""))) for d in data]
-    ctx_lens = [safe_len(d.get("Context")) for d in data]
+class StratifiedSampler:
+    # One reservoir per stratum (each large enough to fill the whole sample), then
+    # a proportional allocation by largest remainder once the stream is exhausted
+    def __init__(self, size, rng, strata):
+        self.size = size
+        self.rng = rng
+        self.strata = strata
+        self.reservoirs = {}
 
+    def add(self, item):
+        label = stratum_of(item, self.strata)
+        if label not in self.reservoirs:
+            self.reservoirs[label] = ReservoirSampler(self.size, self.rng)
+        self.reservoirs[label].add(item)
+
+    def allocation(self):
+        total = sum(r.seen for r in self.reservoirs.values())
+        size = min(self.size, total)
+        if not total:
+            return {}
+        exact = {label: size * r.seen / total for label, r in self.reservoirs.items()}
+        quota = {label: int(x) for label, x in exact.items()}
+        leftover = size - sum(quota.values())
+        for label in sorted(exact, key=lambda k: (quota[k] - exact[k], k))[:leftover]:
+            quota[label] += 1
+        return quota
+
+    def result(self):
+        sample = []
+        for label, quota in sorted(self.allocation().items()):
+            # Reservoir slots are not exchangeable, so subsample rather than slice
+            sample.extend(self.rng.sample(self.reservoirs[label].items, quota))
+        return sample
+
+
+def collect_stats(path, sampler=None, store_builder=None):
+    total = 0
+    with_context = 0
     missing_fields = 0
-    for d in data:
+    seen = set()
+    q_lens, r_lens, ctx_lens = LengthStats(), LengthStats(), LengthStats()
+
+    for d in iter_json_array(path):
+        total += 1
+        if store_builder is not None:
+            store_builder.add(d)
+        if d.get("Context"):
+            with_context += 1
+            if sampler is not None:
+                sampler.add(d)
+
+        q_lens.add(len(tokenize(d.get("Question", ""))))
+        r_lens.add(len(tokenize(d.get("Rewrite", ""))))
+        ctx_lens.add(safe_len(d.get("Context")))
+
         if not d.get("Question") or not d.get("Rewrite"):
             missing_fields += 1
 
-    # Duplicate detection on (Context, Question)
-    seen = Counter()
-    for d in data:
-        ctx = tuple(d.get("Context") or [])
-        key = (ctx, d.get("Question", ""))
-        seen[key] += 1
-    duplicates = sum(v - 1 for v in seen.values() if v > 1)
+        # Duplicate detection on (Context, Question), via a fixed-size digest
+        seen.add(example_key(d))
+
+    lens = {"question": q_lens.values, "rewrite": r_lens.values, "context": ctx_lens.values}
+    return summarize(total, with_context, missing_fields, total - len(seen), lens), lens
+
 
+def stats_from_store(store):
+    # Same numbers as collect_stats, read from the columns of a fresh token store
+    lens = {column: np.asarray(store.lengths(column), dtype=np.uint32) for column in ("question", "rewrite", "context")}
+    total = len(store)
+    with_context = int(np.count_nonzero(lens["context"]))
+    missing_fields = int(np.count_nonzero(store.missing_fields))
+    duplicates = total - len(np.unique(store.example_keys, axis=0)) if total else 0
+    return summarize(total, with_context, missing_fields, duplicates, lens), lens
+
+
+def summarize(total, with_context, missing_fields, duplicates, lens):
     stats = {
         "timestamp": datetime.now().isoformat(),
         "total_examples": total,
-        "with_context": len(with_context),
-        "without_context": no_context,
+        "with_context": with_context,
+        "without_context": total - with_context,
         "missing_fields": missing_fields,
         "duplicates": duplicates,
-        "question_len_mean": float(np.mean(q_lens)),
-        "question_len_std": float(np.std(q_lens)),
-        "rewrite_len_mean": float(np.mean(r_lens)),
-        "rewrite_len_std": float(np.std(r_lens)),
-        "context_len_mean": float(np.mean(ctx_lens)),
-        "context_len_std": float(np.std(ctx_lens)),
     }
+    for column in ("question", "rewrite", "context"):
+        values = np.frombuffer(lens[column], dtype=np.uint32)
+        stats[f"{column}_len_mean"] = float(np.mean(values))
+        stats[f"{column}_len_std"] = float(np.std(values))
+    return stats
 
-    os.makedirs(os.path.dirname(OUTPUT_SAMPLE), exist_ok=True)
 
-    # Sample only from examples with context for intent-preservation testing
-    if len(with_context) < SAMPLE_SIZE:
-        sample = with_context
+def sample_with_context(path, n_with_context, size):
+    # random.sample only looks at the population length, so sampling positions
+    # and fetching them in a second pass reproduces random.sample(with_context, size)
+    if n_with_context < size:
+        positions = list(range(n_with_context))
     else:
-        sample = random.sample(with_context, SAMPLE_SIZE)
+        positions = random.sample(range(n_with_context), size)
+    wanted = {p: None for p in positions}
+    idx = 0
+    for d in iter_json_array(path):
+        if not d.get("Context"):
+            continue
+        if idx in wanted:
+            wanted[idx] = d
+        idx += 1
+    return [wanted[p] for p in positions]
 
-    with open(OUTPUT_SAMPLE, "w") as f:
-        for d in sample:
-            f.write(json.dumps(d, ensure_ascii=False) + "\n")
 
-    with open(STATS_PATH, "w") as f:
-        json.dump(stats, f, indent=2)
+def plot_distributions(ctx_lens, q_lens, r_lens):
+    # matplotlib is only imported when a plot is actually drawn
+    import matplotlib.pyplot as plt
 
-    # Plot distributions
     fig, axes = plt.subplots(1, 3, figsize=(14, 4))
     axes[0].hist(ctx_lens, bins=30, color="#4C72B0")
     axes[0].set_title("Context Length (turns)")
@@ -106,9 +245,76 @@ def main():
     plt.tight_layout()
     fig.savefig(PLOT_PATH, dpi=150)
 
-    print("Wrote:", OUTPUT_SAMPLE)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compute QReCC stats and draw the evaluation sample")
+    parser.add_argument("--data", default=DATA_PATH, help="QReCC JSON array to read")
+    parser.add_argument("--output", default=OUTPUT_SAMPLE, help="where to write sample.jsonl")
+    parser.add_argument("--sample-size", type=int, default=SAMPLE_SIZE)
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--sample-mode", choices=["random", "reservoir", "stratified"], default="random",
+                        help="random reproduces the original sample (two passes); reservoir and "
+                             "stratified sample in the same single pass as the stats")
+    parser.add_argument("--strata", choices=["context", "turn"], default="context",
+                        help="stratify by context length (prior exchanges) or by turn number")
+    parser.add_argument("--token-store", nargs="?", const=TOKEN_STORE_DIR, default=None, metavar="DIR",
+                        help="also write a memory-mappable tokenized copy of the split (see token_store.py)")
+    parser.add_argument("--no-plot", action="store_true", help="skip the distribution plot (and matplotlib)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    set_seed(args.seed)
+
+    sampler = None
+    if args.sample_mode == "reservoir":
+        sampler = ReservoirSampler(args.sample_size, random.Random(args.seed))
+    elif args.sample_mode == "stratified":
+        sampler = StratifiedSampler(args.sample_size, random.Random(args.seed), args.strata)
+
+    # random sampling makes its own pass over the file, so with a store built from
+    # this exact file the stats pass can be skipped; the streaming samplers need it
+    store = None
+    if sampler is None:
+        store = load_token_store(args.token_store or TOKEN_STORE_DIR, source=args.data)
+    if store is not None:
+        stats, lens = stats_from_store(store)
+        print("Read stats from:", store.dir)
+    else:
+        builder = TokenStoreBuilder() if args.token_store else None
+        stats, lens = collect_stats(args.data, sampler, builder)
+        if builder is not None:
+            builder.save(args.token_store, source=source_fingerprint(args.data))
+            print("Wrote:", args.token_store)
+    q_lens = lens["question"]
+    r_lens = lens["rewrite"]
+    ctx_lens = lens["context"]
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+
+    # Sample only from examples with context for intent-preservation testing
+    if sampler is None:
+        sample = sample_with_context(args.data, stats["with_context"], args.sample_size)
+    else:
+        sample = sampler.result()
+    if isinstance(sampler, StratifiedSampler):
+        print("Strata allocation:", sampler.allocation())
+
+    with open(args.output, "w") as f:
+        for d in sample:
+            f.write(json.dumps(d, ensure_ascii=False) + "\n")
+
+    with open(STATS_PATH, "w") as f:
+        json.dump(stats, f, indent=2)
+
+    if not args.no_plot:
+        plot_distributions(ctx_lens, q_lens, r_lens)
+
+    print("Wrote:", args.output)
     print("Wrote:", STATS_PATH)
-    print("Wrote:", PLOT_PATH)
+    if not args.no_plot:
+        print("Wrote:", PLOT_PATH)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import re
+from typing import Callable, Dict, List, Sequence
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+EMBEDDING_DIR = os.getenv("EMBEDDING_CACHE_DIR", os.path.join(ROOT, ".cache", "embeddings"))
+EMBEDDING_DTYPE = os.getenv("EMBEDDING_DTYPE", "float32")
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE", "1").lower() not in ("0", "off", "false", "no")
+
+KEY_BYTES = 16
+
+
+def text_key(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=KEY_BYTES).digest()
+
+
+class EmbeddingStore:
+    """Append-only, memory-mapped matrix of normalized embeddings keyed by text hash.
+
+    One directory per model holds vectors.bin (rows of `dim` values), keys.bin
+    (one fixed-width digest per row) and meta.json. Vectors are appended before
+    their keys and meta.json is written last, so a crash can only leave
+    unreferenced trailing rows or files that are read as an empty store.
+    """
+
+    def __init__(self, model_name: str, root: str = EMBEDDING_DIR, dtype: str = EMBEDDING_DTYPE,
+                 enabled: bool = EMBEDDING_CACHE_ENABLED):
+        self.model_name = model_name
+        self.dir = os.path.join(root, re.sub(r"[^\w.-]+", "_", model_name))
+        self.enabled = enabled
+        self.dtype = np.dtype(dtype)
+        self.dim = None
+        self.rows: Dict[bytes, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self._matrix = None
+        if enabled:
+            self._load()
+
+    @property
+    def vectors_path(self):
+        return os.path.join(self.dir, "vectors.bin")
+
+    @property
+    def keys_path(self):
+        return os.path.join(self.dir, "keys.bin")
+
+    @property
+    def meta_path(self):
+        return os.path.join(self.dir, "meta.json")
+
+    def _load(self):
+        if not os.path.exists(self.meta_path):
+            return
+        with open(self.meta_path) as f:
+            meta = json.load(f)
+        if meta.get("model") != self.model_name:
+            raise ValueError(f"{self.dir} holds embeddings for {meta.get('model')}, not {self.model_name}")
+        self.dim = int(meta["dim"])
+        self.dtype = np.dtype(meta["dtype"])
+        row_bytes = self.dim * self.dtype.itemsize
+        n_vectors = os.path.getsize(self.vectors_path) // row_bytes if os.path.exists(self.vectors_path) else 0
+        raw = b""
+        if os.path.exists(self.keys_path):
+            with open(self.keys_path, "rb") as f:
+                raw = f.read()
+        n = min(len(raw) // KEY_BYTES, n_vectors)
+        self.rows = {raw[i * KEY_BYTES:(i + 1) * KEY_BYTES]: i for i in range(n)}
+
+    def _map(self):
+        n = len(self.rows)
+        if self._matrix is None or self._matrix.shape[0] != n:
+            self._matrix = np.memmap(self.vectors_path, dtype=self.dtype, mode="r", shape=(n, self.dim))
+        return self._matrix
+
+    def _append(self, keys: List[bytes], vectors: np.ndarray):
+        os.makedirs(self.dir, exist_ok=True)
+        new_store = self.dim is None
+        if new_store:
+            self.dim = int(vectors.shape[1])
+        start = len(self.rows)
+        row_bytes = self.dim * self.dtype.itemsize
+        with open(self.vectors_path, "r+b" if os.path.exists(self.vectors_path) else "wb") as f:
+            # Drop rows a crash left behind without keys
+            f.truncate(start * row_bytes)
+            f.seek(start * row_bytes)
+            f.write(np.ascontiguousarray(vectors, dtype=self.dtype).tobytes())
+        with open(self.keys_path, "r+b" if os.path.exists(self.keys_path) else "wb") as f:
+            f.truncate(start * KEY_BYTES)
+            f.seek(start * KEY_BYTES)
+            f.write(b"".join(keys))
+        if new_store:
+            # Until meta.json exists the files above are ignored and rewritten from row 0
+            tmp_path = self.meta_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"model": self.model_name, "dim": self.dim, "dtype": self.dtype.name}, f)
+            os.replace(tmp_path, self.meta_path)
+        for i, key in enumerate(keys):
+            self.rows[key] = start + i
+        self._matrix = None
+
+    def embed(self, texts: Sequence[str], encode: Callable[[List[str]], np.ndarray]) -> np.ndarray:
+        """Return float32 embeddings for texts, calling encode only on unseen strings."""
+        keys = [text_key(t) for t in texts]
+        unique = {}
+        for key, text in zip(keys, texts):
+            unique.setdefault(key, text)
+        if not self.enabled:
+            vectors = np.asarray(encode(list(unique.values())), dtype=np.float32)
+            pos = {key: i for i, key in enumerate(unique)}
+            return vectors[[pos[k] for k in keys]] if keys else vectors
+
+        missing = [key for key in unique if key not in self.rows]
+        self.hits += len(unique) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            vectors = np.asarray(encode([unique[key] for key in missing]), dtype=np.float32)
+            self._append(missing, vectors)
+        if not keys:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        return np.asarray(self._map()[[self.rows[k] for k in keys]], dtype=np.float32)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "rows": len(self.rows)}
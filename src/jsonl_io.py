@@ -0,0 +1,291 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+JSONL_FLUSH_S = float(os.getenv("JSONL_FLUSH_S", "1.0"))
+JSONL_FLUSH_EVERY = int(os.getenv("JSONL_FLUSH_EVERY", "50"))
+JSONL_FSYNC = os.getenv("JSONL_FSYNC", "0").lower() in ("1", "true", "yes")
+
+
+def repair_jsonl(path: str) -> int:
+    # A crash mid-write leaves a last line without its newline; cut it off so the
+    # next append starts on a fresh line. Returns the number of bytes dropped.
+    if not os.path.exists(path):
+        return 0
+    with open(path, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return 0
+        f.seek(size - 1)
+        if f.read(1) == b"\n":
+            return 0
+        pos = size
+        block = 1 << 16
+        while pos > 0:
+            start = max(0, pos - block)
+            f.seek(start)
+            chunk = f.read(pos - start)
+            nl = chunk.rfind(b"\n")
+            if nl != -1:
+                keep = start + nl + 1
+                break
+            pos = start
+        else:
+            keep = 0
+        f.truncate(keep)
+    dropped = size - keep
+    print(f"Dropped a torn trailing record ({dropped} bytes) from {path}")
+    return dropped
+
+
+def iter_jsonl(path: str) -> Iterator[Dict[str, Any]]:
+    # Tolerates a torn final record; corruption anywhere else still raises
+    with open(path, "r") as f:
+        pending = None
+        for line in f:
+            if pending is not None:
+                yield json.loads(pending)
+            pending = line
+        if pending is None:
+            return
+        try:
+            obj = json.loads(pending)
+        except json.JSONDecodeError:
+            print(f"Ignoring torn trailing record in {path}")
+            return
+        yield obj
+
+
+# Sidecar index: a header naming the data file by a hash of its first record,
+# then one "offset<TAB>length<TAB>key" line per record, so resuming only reads
+# the index and single records can be fetched by seeking
+IndexEntry = Tuple[int, int]
+KeyFn = Callable[[Dict[str, Any]], str]
+INDEX_HEADER = "#first-record"
+
+
+def index_path(path: str) -> str:
+    return path + ".idx"
+
+
+def index_header(first_line: bytes) -> str:
+    return f"{INDEX_HEADER}\t{hashlib.sha1(first_line).hexdigest()}\n"
+
+
+def _first_line(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.readline()
+
+
+def _scan_entries(path: str, key_fn: KeyFn, start: int) -> Iterator[Tuple[str, int, int]]:
+    with open(path, "rb") as f:
+        f.seek(start)
+        offset = start
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            yield key_fn(json.loads(line)), offset, len(line)
+            offset += len(line)
+
+
+def _read_sidecar(idx: str, size: int):
+    # Returns (header, entries, stale); entries past the data's end are dropped
+    header, entries, stale = None, {}, False
+    with open(idx, "r") as f:
+        for line in f:
+            if line.startswith(INDEX_HEADER):
+                header = line
+                continue
+            parts = line.rstrip("\n").split("\t", 2)
+            if len(parts) != 3 or not line.endswith("\n"):
+                stale = True
+                continue
+            offset, length, key = int(parts[0]), int(parts[1]), parts[2]
+            if offset + length > size:
+                stale = True
+                continue
+            entries[key] = (offset, length)
+    return header, entries, stale
+
+
+def _matches(path: str, key_fn: KeyFn, entries: Dict[str, IndexEntry]) -> bool:
+    # The record at the last indexed offset must exist there and carry that key
+    if not entries:
+        return True
+    key, (offset, length) = max(entries.items(), key=lambda kv: kv[1][0])
+    with open(path, "rb") as f:
+        f.seek(offset)
+        line = f.read(length)
+    try:
+        return line.endswith(b"\n") and key_fn(json.loads(line)) == key
+    except (ValueError, KeyError, TypeError):
+        return False
+
+
+def load_index(path: str, key_fn: KeyFn) -> Dict[str, IndexEntry]:
+    """Map key -> (offset, length) for every complete record in ``path``.
+
+    The sidecar is trusted only for the data file it was built from: its header
+    must match the file's first record and the last indexed record must carry
+    its key, otherwise it is rebuilt by a full scan. A sidecar without data is
+    removed. Entries past the end (data truncated after a crash) are dropped,
+    and records appended without indexing are scanned from the last indexed
+    byte and added. Later records for the same key win, matching a full reparse.
+    """
+    idx = index_path(path)
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        # e.g. the data file was deleted to start over; old keys must not count as done
+        if os.path.exists(idx):
+            os.remove(idx)
+        return {}
+    size = os.path.getsize(path)
+    header = index_header(_first_line(path))
+    entries: Dict[str, IndexEntry] = {}
+    stale = True
+    if os.path.exists(idx):
+        found, entries, stale = _read_sidecar(idx, size)
+        if found != header or not _matches(path, key_fn, entries):
+            if found is not None:
+                print(f"Rebuilding {idx}: it does not match {path}")
+            entries, stale = {}, True
+    indexed_end = max((offset + length for offset, length in entries.values()), default=0)
+
+    tail = []
+    if indexed_end < size:
+        tail = list(_scan_entries(path, key_fn, indexed_end))
+        for key, offset, length in tail:
+            entries[key] = (offset, length)
+
+    if stale:
+        with open(idx, "w") as f:
+            f.write(header)
+            for key, (offset, length) in sorted(entries.items(), key=lambda kv: kv[1][0]):
+                f.write(f"{offset}\t{length}\t{key}\n")
+    elif tail:
+        with open(idx, "a") as f:
+            for key, offset, length in tail:
+                f.write(f"{offset}\t{length}\t{key}\n")
+    return entries
+
+
+def read_record(path: str, entry: IndexEntry) -> Dict[str, Any]:
+    offset, length = entry
+    with open(path, "rb") as f:
+        f.seek(offset)
+        return json.loads(f.read(length))
+
+
+def read_records(path: str, entries: Iterable[IndexEntry]) -> Iterator[Dict[str, Any]]:
+    with open(path, "rb") as f:
+        for offset, length in entries:
+            f.seek(offset)
+            yield json.loads(f.read(length))
+
+
+class JsonlWriter:
+    """Append-only JSONL writer shared by concurrent producers.
+
+    Records are buffered and written every ``flush_every`` records or
+    ``flush_interval`` seconds, whichever comes first, and on close; with
+    ``fsync`` each flush is also forced to disk. A background thread enforces
+    the interval while no records arrive. A lock makes ``write`` safe from
+    several threads, and it never yields, so asyncio tasks can share it.
+    With ``key_fn`` the sidecar index is kept in step, written after the data
+    it points to.
+    """
+
+    def __init__(self, path: str, flush_interval: float = JSONL_FLUSH_S,
+                 flush_every: int = JSONL_FLUSH_EVERY, fsync: bool = JSONL_FSYNC,
+                 key_fn: Optional[KeyFn] = None):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_every = max(1, flush_every)
+        self.fsync = fsync
+        self.key_fn = key_fn
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._keys = []
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        repair_jsonl(path)
+        self._index = None
+        if key_fn is not None:
+            load_index(path, key_fn)
+            self._index = open(index_path(path), "a")
+        self._file = open(path, "ab")
+        self._last_flush = time.monotonic()
+        self._closed = threading.Event()
+        self._timer = None
+        if 0 < self.flush_interval < float("inf"):
+            self._timer = threading.Thread(target=self._flush_periodically, daemon=True,
+                                           name=f"jsonl-flush:{os.path.basename(path)}")
+            self._timer.start()
+
+    def write(self, obj: Dict[str, Any]) -> None:
+        line = (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+        key = self.key_fn(obj) if self.key_fn is not None else None
+        with self._lock:
+            self._buffer.append(line)
+            self._keys.append(key)
+            if (len(self._buffer) >= self.flush_every
+                    or time.monotonic() - self._last_flush >= self.flush_interval):
+                self._flush_locked()
+
+    def _flush_periodically(self) -> None:
+        # write() only checks the interval when a record arrives; this bounds how long
+        # finished records wait while producers are idle, e.g. on slow judge calls
+        timeout = self.flush_interval
+        while not self._closed.wait(timeout):
+            with self._lock:
+                timeout = self.flush_interval
+                if self._buffer:
+                    due = self._last_flush + self.flush_interval - time.monotonic()
+                    if due > 0:
+                        timeout = due
+                    else:
+                        self._flush_locked()
+
+    def _flush_locked(self) -> None:
+        if self._buffer:
+            offset = self._file.seek(0, os.SEEK_END)
+            self._file.write(b"".join(self._buffer))
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            if self._index is not None:
+                if offset == 0:
+                    # A fresh data file: name it in a fresh sidecar
+                    self._index.seek(0)
+                    self._index.truncate()
+                    self._index.write(index_header(self._buffer[0]))
+                for line, key in zip(self._buffer, self._keys):
+                    self._index.write(f"{offset}\t{len(line)}\t{key}\n")
+                    offset += len(line)
+                self._index.flush()
+            self._buffer.clear()
+            self._keys.clear()
+        self._last_flush = time.monotonic()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush_locked()
+
+    def close(self) -> None:
+        self._closed.set()
+        if self._timer is not None and self._timer is not threading.current_thread():
+            self._timer.join()
+        with self._lock:
+            if self._file.closed:
+                return
+            self._flush_locked()
+            self._file.close()
+            if self._index is not None:
+                self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
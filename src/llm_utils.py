@@ -1,4 +1,4 @@
-import json
+import asyncio
 import os
 import time
 from dataclasses import dataclass
@@ -6,8 +6,12 @@ from typing import Any, Dict, Optional
 
 from tenacity import retry, stop_after_attempt, wait_exponential
 
+from llm_cache import ResponseCache, cache_key, shared_response_cache
+from rate_limit import AdaptiveConcurrency, RateLimiter, estimate_tokens, shared_rate_limiter
+from structured_output import parse_json, response_format
+
 try:
-    from openai import OpenAI
+    from openai import AsyncOpenAI, OpenAI, RateLimitError
 except Exception as exc:  # pragma: no cover
     raise RuntimeError("openai package not available") from exc
 
@@ -18,58 +22,232 @@ class LLMConfig:
     temperature: float = 0.0
     max_tokens: int = 512
     top_p: float = 1.0
+    # JSON schema of the reply: sent as response_format when RESPONSE_FORMAT asks for
+    # it, and always used to coerce scalar types in the reply
+    schema: Optional[Dict[str, Any]] = None
+    schema_name: str = "reply"
+
+
+def client_kwargs() -> Dict[str, Any]:
+    # Retries are handled by tenacity below; SDK-internal retries would hide 429s
+    # from the rate limiter
+    openai_key = os.getenv("OPENAI_API_KEY")
+    openrouter_key = os.getenv("OPENROUTER_API_KEY")
+    if openai_key:
+        # OPENAI_BASE_URL (e.g. a local stub server) is picked up by the SDK itself
+        return {"api_key": openai_key, "max_retries": 0}
+    if openrouter_key:
+        base_url = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+        return {"api_key": openrouter_key, "base_url": base_url, "max_retries": 0}
+    raise RuntimeError("Missing OPENAI_API_KEY or OPENROUTER_API_KEY in environment")
+
+
+def request_kwargs(system: str, user: str, cfg: LLMConfig) -> Dict[str, Any]:
+    kwargs = {
+        "model": cfg.model,
+        "messages": [
+            {"role": "system", "content": system},
+            {"role": "user", "content": user},
+        ],
+        "temperature": cfg.temperature,
+        "top_p": cfg.top_p,
+        "max_tokens": cfg.max_tokens,
+    }
+    fmt = response_format(cfg.schema_name, cfg.schema)
+    if fmt is not None:
+        kwargs["response_format"] = fmt
+    return kwargs
+
+
+def request_key(system: str, user: str, cfg: LLMConfig) -> str:
+    return cache_key(cfg.model, system, user, cfg.temperature, cfg.top_p, cfg.max_tokens,
+                     response_format(cfg.schema_name, cfg.schema))
+
+
+def _cached_result(hit: Dict[str, Any], key: str) -> Dict[str, Any]:
+    return {"content": hit["content"], "usage": hit["usage"], "duration_s": 0.0, "cached": True, "key": key}
+
+
+def _remember(cache: ResponseCache, out: Dict[str, Any]) -> None:
+    # Called only once the reply has been parsed, so a malformed reply is never replayed
+    if not out["cached"]:
+        cache.put(out["key"], {"content": out["content"], "usage": out["usage"]})
+
+
+def _parse_reply(client, out: Dict[str, Any], cfg: LLMConfig) -> Any:
+    # Fences, surrounding prose and stringly-typed scalars are fixed locally; only a
+    # reply with no recoverable JSON object, or one missing a required key, raises
+    # and costs a retried request
+    try:
+        data, repaired = parse_json(out["content"], cfg.schema)
+    except ValueError:
+        if out["cached"]:
+            # Cached before required keys were checked; the retry asks the provider again
+            client.cache.delete(out["key"])
+        raise
+    client.repaired_replies += repaired
+    return data
+
+
+def _retry_after(exc: RateLimitError) -> float:
+    try:
+        return float(exc.response.headers.get("retry-after", 1.0))
+    except (AttributeError, TypeError, ValueError):
+        return 1.0
+
+
+def cached_prompt_tokens(usage: Dict[str, Any]) -> int:
+    # OpenAI-style usage reports provider prefix-cache hits under prompt_tokens_details
+    details = usage.get("prompt_tokens_details") or {}
+    return int(details.get("cached_tokens") or 0)
+
+
+class UsageTotals:
+    """Prompt and prefix-cached token counts over the requests actually sent."""
+
+    def __init__(self):
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.requests_with_cache_hits = 0
+
+    def add(self, usage: Dict[str, Any]) -> None:
+        cached = cached_prompt_tokens(usage)
+        self.requests += 1
+        self.prompt_tokens += int(usage.get("prompt_tokens") or 0)
+        self.cached_tokens += cached
+        self.requests_with_cache_hits += cached > 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_prompt_tokens": self.cached_tokens,
+            "requests_with_cache_hits": self.requests_with_cache_hits,
+            "prefix_cache_hit_rate": self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0,
+        }
 
 
 class LLMClient:
-    def __init__(self, model: str):
+    def __init__(self, model: str, limiter: Optional[RateLimiter] = None,
+                 cache: Optional[ResponseCache] = None):
         self.model = model
         self.client = self._build_client()
+        self.limiter = limiter or shared_rate_limiter()
+        self.cache = cache or shared_response_cache()
+        self.usage = UsageTotals()
+        self.repaired_replies = 0
 
     def _build_client(self) -> OpenAI:
-        openai_key = os.getenv("OPENAI_API_KEY")
-        openrouter_key = os.getenv("OPENROUTER_API_KEY")
-        if openai_key:
-            return OpenAI(api_key=openai_key)
-        if openrouter_key:
-            base_url = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
-            return OpenAI(api_key=openrouter_key, base_url=base_url)
-        raise RuntimeError("Missing OPENAI_API_KEY or OPENROUTER_API_KEY in environment")
+        return OpenAI(**client_kwargs())
 
-    @retry(wait=wait_exponential(min=1, max=20), stop=stop_after_attempt(5))
-    def chat_json(self, system: str, user: str, config: Optional[LLMConfig] = None) -> Dict[str, Any]:
-        cfg = config or LLMConfig(model=self.model)
+    def _complete(self, system: str, user: str, cfg: LLMConfig) -> Dict[str, Any]:
+        key = request_key(system, user, cfg)
+        hit = self.cache.get(key)
+        if hit is not None:
+            return _cached_result(hit, key)
+        est = estimate_tokens(system, user, cfg.max_tokens)
+        self.limiter.acquire(est)
         start = time.time()
-        resp = self.client.chat.completions.create(
-            model=cfg.model,
-            messages=[
-                {"role": "system", "content": system},
-                {"role": "user", "content": user},
-            ],
-            temperature=cfg.temperature,
-            top_p=cfg.top_p,
-            max_tokens=cfg.max_tokens,
-        )
+        try:
+            resp = self.client.chat.completions.create(**request_kwargs(system, user, cfg))
+        except RateLimitError as exc:
+            self.limiter.pause(_retry_after(exc))
+            raise
         duration = time.time() - start
-        content = resp.choices[0].message.content
-        data = json.loads(content)
         usage = resp.usage.model_dump() if resp.usage else {}
-        return {"data": data, "usage": usage, "duration_s": duration}
+        self.limiter.reconcile(est, usage.get("total_tokens"))
+        self.usage.add(usage)
+        content = resp.choices[0].message.content
+        return {"content": content, "usage": usage, "duration_s": duration, "cached": False, "key": key}
+
+    @retry(wait=wait_exponential(min=1, max=20), stop=stop_after_attempt(5))
+    def chat_json(self, system: str, user: str, config: Optional[LLMConfig] = None) -> Dict[str, Any]:
+        cfg = config or LLMConfig(model=self.model)
+        out = self._complete(system, user, cfg)
+        data = _parse_reply(self, out, cfg)
+        _remember(self.cache, out)
+        return {"data": data, "usage": out["usage"], "duration_s": out["duration_s"], "cached": out["cached"]}
 
     @retry(wait=wait_exponential(min=1, max=20), stop=stop_after_attempt(5))
     def chat_text(self, system: str, user: str, config: Optional[LLMConfig] = None) -> Dict[str, Any]:
         cfg = config or LLMConfig(model=self.model)
+        out = self._complete(system, user, cfg)
+        _remember(self.cache, out)
+        return {"data": out["content"], "usage": out["usage"], "duration_s": out["duration_s"], "cached": out["cached"]}
+
+
+class AsyncLLMClient:
+    # Coroutine counterpart of LLMClient; returns the same result dicts
+    def __init__(self, model: str, limiter: Optional[RateLimiter] = None,
+                 concurrency: Optional[AdaptiveConcurrency] = None, cache: Optional[ResponseCache] = None):
+        self.model = model
+        self.client = self._build_client()
+        self.limiter = limiter or shared_rate_limiter()
+        self.concurrency = concurrency
+        self.cache = cache or shared_response_cache()
+        self.usage = UsageTotals()
+        self.repaired_replies = 0
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    def _build_client(self) -> AsyncOpenAI:
+        return AsyncOpenAI(**client_kwargs())
+
+    async def _timed_create(self, system: str, user: str, cfg: LLMConfig):
         start = time.time()
-        resp = self.client.chat.completions.create(
-            model=cfg.model,
-            messages=[
-                {"role": "system", "content": system},
-                {"role": "user", "content": user},
-            ],
-            temperature=cfg.temperature,
-            top_p=cfg.top_p,
-            max_tokens=cfg.max_tokens,
-        )
-        duration = time.time() - start
-        content = resp.choices[0].message.content
+        try:
+            resp = await self.client.chat.completions.create(**request_kwargs(system, user, cfg))
+        except RateLimitError as exc:
+            self.limiter.pause(_retry_after(exc))
+            if self.concurrency is not None:
+                self.concurrency.on_rate_limited()
+            raise
+        return resp, time.time() - start
+
+    async def _complete(self, system: str, user: str, cfg: LLMConfig) -> Dict[str, Any]:
+        key = request_key(system, user, cfg)
+        hit = self.cache.get(key)
+        if hit is not None:
+            return _cached_result(hit, key)
+        pending = self._inflight.get(key)
+        if pending is not None:
+            # An identical request (e.g. from an overlapping sweep cell) is already
+            # in flight; share its reply instead of paying for it twice
+            out = await asyncio.shield(pending)
+            return {**out, "duration_s": 0.0, "cached": True}
+        task = asyncio.ensure_future(self._fetch(key, system, user, cfg))
+        self._inflight[key] = task
+        try:
+            return await task
+        finally:
+            self._inflight.pop(key, None)
+
+    async def _fetch(self, key: str, system: str, user: str, cfg: LLMConfig) -> Dict[str, Any]:
+        est = estimate_tokens(system, user, cfg.max_tokens)
+        await self.limiter.acquire_async(est)
+        if self.concurrency is None:
+            resp, duration = await self._timed_create(system, user, cfg)
+        else:
+            async with self.concurrency:
+                resp, duration = await self._timed_create(system, user, cfg)
+            self.concurrency.on_success(duration)
         usage = resp.usage.model_dump() if resp.usage else {}
-        return {"data": content, "usage": usage, "duration_s": duration}
+        self.limiter.reconcile(est, usage.get("total_tokens"))
+        self.usage.add(usage)
+        content = resp.choices[0].message.content
+        return {"content": content, "usage": usage, "duration_s": duration, "cached": False, "key": key}
+
+    @retry(wait=wait_exponential(min=1, max=20), stop=stop_after_attempt(5))
+    async def chat_json(self, system: str, user: str, config: Optional[LLMConfig] = None) -> Dict[str, Any]:
+        cfg = config or LLMConfig(model=self.model)
+        out = await self._complete(system, user, cfg)
+        data = _parse_reply(self, out, cfg)
+        _remember(self.cache, out)
+        return {"data": data, "usage": out["usage"], "duration_s": out["duration_s"], "cached": out["cached"]}
+
+    @retry(wait=wait_exponential(min=1, max=20), stop=stop_after_attempt(5))
+    async def chat_text(self, system: str, user: str, config: Optional[LLMConfig] = None) -> Dict[str, Any]:
+        cfg = config or LLMConfig(model=self.model)
+        out = await self._complete(system, user, cfg)
+        _remember(self.cache, out)
+        return {"data": out["content"], "usage": out["usage"], "duration_s": out["duration_s"], "cached": out["cached"]}
@@ -0,0 +1,107 @@
+import re
+from typing import Callable, Dict, Iterable, List, Sequence
+
+import numpy as np
+
+# Lowercased words and single punctuation marks (BLEU-1)
+BLEU_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+
+def bleu_tokenize(text: str) -> List[str]:
+    return BLEU_TOKEN_RE.findall(text.lower())
+
+
+class Interner:
+    # Maps tokens to dense int ids and memoizes each distinct text, so strings
+    # shared across methods (or repeated golds) are tokenized once
+    def __init__(self, tokenize: Callable[[str], List[str]]):
+        self.tokenize = tokenize
+        self.ids: Dict[str, int] = {}
+        self._texts: Dict[str, np.ndarray] = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def encode(self, text: str) -> np.ndarray:
+        cached = self._texts.get(text)
+        if cached is None:
+            cached = np.fromiter(
+                (self.ids.setdefault(tok, len(self.ids)) for tok in self.tokenize(text)),
+                dtype=np.int64,
+            )
+            self._texts[text] = cached
+        return cached
+
+    def encode_all(self, texts: Iterable[str]) -> List[np.ndarray]:
+        return [self.encode(t) for t in texts]
+
+
+def _flatten(seqs: Sequence[np.ndarray]):
+    lens = np.fromiter((len(s) for s in seqs), dtype=np.int64, count=len(seqs))
+    flat = np.concatenate(seqs) if len(seqs) else np.zeros(0, dtype=np.int64)
+    owner = np.repeat(np.arange(len(seqs)), lens)
+    return flat.astype(np.int64), owner, lens
+
+
+def bleu1_scores(refs: Sequence[np.ndarray], hyps: Sequence[np.ndarray], vocab_size: int) -> np.ndarray:
+    """Unclipped unigram precision, the baseline BLEU-1 used for the published results.
+
+    Per pair this is sum(tok in ref for tok in hyp) / len(hyp) over bleu_tokenize
+    tokens, with repeated hypothesis tokens each counted and 0.0 for an empty
+    hypothesis.
+
+    Every (pair, token) is folded into one int64 key, so reference membership
+    for all pairs is a single np.isin over bags of ids.
+    """
+    n = len(hyps)
+    hyp_flat, hyp_owner, hyp_lens = _flatten(hyps)
+    ref_flat, ref_owner, _ = _flatten(refs)
+    width = max(vocab_size, 1)
+    ref_keys = np.unique(ref_owner * width + ref_flat)
+    hits = np.isin(hyp_owner * width + hyp_flat, ref_keys)
+    overlap = np.bincount(hyp_owner, weights=hits, minlength=n)
+    return np.where(hyp_lens > 0, overlap / np.maximum(hyp_lens, 1), 0.0)
+
+
+def lcs_length(a: np.ndarray, b: np.ndarray) -> int:
+    # Bit-parallel LCS (Allison-Dix / Hyyro): one big-int update per token of b
+    # instead of an O(len(a) * len(b)) Python table
+    if len(a) == 0 or len(b) == 0:
+        return 0
+    masks: Dict[int, int] = {}
+    for i, tok in enumerate(a.tolist()):
+        masks[tok] = masks.get(tok, 0) | (1 << i)
+    full = (1 << len(a)) - 1
+    v = full
+    for tok in b.tolist():
+        u = v & masks.get(tok, 0)
+        v = ((v + u) | (v - u)) & full
+    return len(a) - bin(v).count("1")
+
+
+def rougeL_scores(refs: Sequence[np.ndarray], hyps: Sequence[np.ndarray]) -> np.ndarray:
+    # Same F-measure as rouge_score's _score_lcs(target=ref, prediction=hyp)
+    out = np.zeros(len(hyps), dtype=np.float64)
+    memo: Dict[tuple, float] = {}
+    for i, (ref, hyp) in enumerate(zip(refs, hyps)):
+        if len(ref) == 0 or len(hyp) == 0:
+            continue
+        key = (ref.tobytes(), hyp.tobytes())
+        score = memo.get(key)
+        if score is None:
+            lcs = lcs_length(ref, hyp)
+            precision = lcs / len(hyp)
+            recall = lcs / len(ref)
+            score = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+            memo[key] = score
+        out[i] = score
+    return out
+
+
+def rowwise_cosine(a, b) -> np.ndarray:
+    # Embeddings are L2-normalized, so cosine is a row-wise dot product; one
+    # reduction and one device-to-host copy for the whole matrix
+    sims = (a * b).sum(-1)
+    if hasattr(sims, "cpu"):
+        sims = sims.cpu().numpy()
+    return np.asarray(sims, dtype=np.float64)
@@ -0,0 +1,150 @@
+import json
+import math
+from typing import Dict, Iterable, Mapping, Optional, Set, Tuple
+
+
+class RunningMoments:
+    """Welford running count/mean/M2; mergeable with Chan et al.'s parallel update."""
+
+    __slots__ = ("n", "mean", "m2")
+
+    def __init__(self, n: int = 0, mean: float = 0.0, m2: float = 0.0):
+        self.n = n
+        self.mean = mean
+        self.m2 = m2
+
+    def update(self, x: float) -> None:
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    def merge(self, other: "RunningMoments") -> "RunningMoments":
+        if other.n == 0:
+            return self
+        if self.n == 0:
+            self.n, self.mean, self.m2 = other.n, other.mean, other.m2
+            return self
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean += delta * other.n / n
+        self.m2 += other.m2 + delta * delta * self.n * other.n / n
+        self.n = n
+        return self
+
+    def variance(self, ddof: int = 0) -> float:
+        if self.n - ddof <= 0:
+            return math.nan
+        return max(self.m2, 0.0) / (self.n - ddof)
+
+    def std(self, ddof: int = 0) -> float:
+        return math.sqrt(self.variance(ddof))
+
+    def to_list(self):
+        return [self.n, self.mean, self.m2]
+
+    @classmethod
+    def from_list(cls, values) -> "RunningMoments":
+        n, mean, m2 = values
+        return cls(int(n), float(mean), float(m2))
+
+
+def paired_ttest(diff: RunningMoments) -> Tuple[float, float]:
+    # Same statistic as scipy.stats.ttest_rel(b, a), from the moments of b - a
+    from scipy import stats
+
+    if diff.n < 2:
+        return math.nan, math.nan
+    se = math.sqrt(diff.variance(ddof=1) / diff.n)
+    if se == 0:
+        t_stat = math.nan if diff.mean == 0 else math.copysign(math.inf, diff.mean)
+    else:
+        t_stat = diff.mean / se
+    p_val = math.nan if math.isnan(t_stat) else float(2 * stats.t.sf(abs(t_stat), diff.n - 1))
+    return t_stat, p_val
+
+
+class OnlineAggregator:
+    """Per-(method, metric) moments plus moments of paired differences b - a.
+
+    Examples can be added one at a time as they are scored; aggregators built on
+    separate shards are combined with merge() and round-trip through to_dict().
+    The ids of folded examples are kept so a saved state can be extended with
+    only the examples it has not seen.
+    """
+
+    def __init__(self, pair: Tuple[str, str], paired_metrics: Iterable[str]):
+        self.pair = tuple(pair)
+        self.paired_metrics = list(paired_metrics)
+        self.moments: Dict[Tuple[str, str], RunningMoments] = {}
+        self.diffs: Dict[str, RunningMoments] = {}
+        self.example_ids: Set[str] = set()
+
+    def add(self, method: str, metric: str, value: float) -> None:
+        self.moments.setdefault((method, metric), RunningMoments()).update(float(value))
+
+    def add_example(self, values: Mapping[str, Mapping[str, Optional[float]]],
+                    example_id: Optional[str] = None) -> None:
+        """values maps method -> metric -> value (None = missing) for one example."""
+        if example_id is not None:
+            self.example_ids.add(example_id)
+        for method, metrics in values.items():
+            for metric, value in metrics.items():
+                if value is not None:
+                    self.add(method, metric, value)
+        a, b = (values.get(m, {}) for m in self.pair)
+        for metric in self.paired_metrics:
+            if a.get(metric) is not None and b.get(metric) is not None:
+                self.diffs.setdefault(metric, RunningMoments()).update(float(b[metric]) - float(a[metric]))
+
+    def get(self, method: str, metric: str) -> RunningMoments:
+        return self.moments.get((method, metric), RunningMoments())
+
+    def diff(self, metric: str) -> RunningMoments:
+        return self.diffs.get(metric, RunningMoments())
+
+    def methods(self):
+        return {method for method, _ in self.moments}
+
+    def merge(self, other: "OnlineAggregator") -> "OnlineAggregator":
+        if other.pair != self.pair:
+            raise ValueError(f"Cannot merge aggregators for pairs {self.pair} and {other.pair}")
+        overlap = self.example_ids & other.example_ids
+        if overlap:
+            raise ValueError(f"Cannot merge aggregators that share {len(overlap)} examples, "
+                             f"e.g. {min(overlap)!r}")
+        for key, moments in other.moments.items():
+            self.moments.setdefault(key, RunningMoments()).merge(moments)
+        for metric, moments in other.diffs.items():
+            self.diffs.setdefault(metric, RunningMoments()).merge(moments)
+        self.example_ids |= other.example_ids
+        return self
+
+    def to_dict(self):
+        return {
+            "pair": list(self.pair),
+            "paired_metrics": self.paired_metrics,
+            "moments": {f"{method}\t{metric}": m.to_list() for (method, metric), m in self.moments.items()},
+            "diffs": {metric: m.to_list() for metric, m in self.diffs.items()},
+            "example_ids": sorted(self.example_ids),
+        }
+
+    @classmethod
+    def from_dict(cls, data) -> "OnlineAggregator":
+        agg = cls(tuple(data["pair"]), data["paired_metrics"])
+        for key, values in data["moments"].items():
+            method, metric = key.split("\t", 1)
+            agg.moments[(method, metric)] = RunningMoments.from_list(values)
+        agg.diffs = {metric: RunningMoments.from_list(values) for metric, values in data["diffs"].items()}
+        # States saved before ids were recorded load with none
+        agg.example_ids = set(data.get("example_ids", []))
+        return agg
+
+    def save(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, path: str) -> "OnlineAggregator":
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
@@ -0,0 +1,27 @@
+import os
+
+# "legacy" keeps each stage's own system prompt in front of the conversation.
+# "shared" puts an identical system preamble and conversation first for every
+# stage of an example (and for the judge), with the stage's instructions after
+# them, so provider-side prefix caching can reuse the conversation tokens.
+PROMPT_LAYOUTS = ("legacy", "shared")
+PROMPT_LAYOUT = os.getenv("PROMPT_LAYOUT", "legacy")
+
+SHARED_SYSTEM = (
+    "You assist with a study of conversational question rewriting. Each request shows a "
+    "conversation between a user and an assistant, followed by one task about it. "
+    "Follow the task instructions exactly. Return JSON only."
+)
+
+
+def conversation_block(context: str) -> str:
+    return f"Conversation:\n{context}\n\n"
+
+
+def assemble(layout: str, instructions: str, context: str, body: str):
+    """Return (system, user) messages for a task with the given instructions and body text."""
+    if layout == "shared":
+        return SHARED_SYSTEM, f"{conversation_block(context)}Task: {instructions}\n\n{body}"
+    if layout == "legacy":
+        return instructions, conversation_block(context) + body
+    raise ValueError(f"Unknown prompt layout {layout!r}; expected one of {PROMPT_LAYOUTS}")
@@ -0,0 +1,133 @@
+import asyncio
+import os
+import threading
+import time
+from typing import Optional
+
+RPM_LIMIT = int(os.getenv("RPM_LIMIT", "0"))
+TPM_LIMIT = int(os.getenv("TPM_LIMIT", "0"))
+
+# Rough chars-per-token ratio used to budget a request before its usage is known
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(system: str, user: str, max_tokens: int) -> int:
+    return (len(system) + len(user)) // CHARS_PER_TOKEN + max_tokens
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60.0
+        self.capacity = float(per_minute)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float, now: float) -> float:
+        # Take the amount up front (the level may go negative) and report how long
+        # the caller has to wait until the debt is paid back
+        self._refill(now)
+        self.level -= amount
+        return max(0.0, -self.level / self.rate)
+
+    def credit(self, amount: float, now: float) -> None:
+        self._refill(now)
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute budget shared by every client."""
+
+    def __init__(self, rpm: int = 0, tpm: int = 0):
+        self._lock = threading.Lock()
+        self.requests = TokenBucket(rpm) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm) if tpm > 0 else None
+        self.paused_until = 0.0
+
+    def _reserve(self, est_tokens: int) -> float:
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self.paused_until - now)
+            if self.requests is not None:
+                wait = max(wait, self.requests.reserve(1, now))
+            if self.tokens is not None:
+                wait = max(wait, self.tokens.reserve(est_tokens, now))
+            return wait
+
+    def acquire(self, est_tokens: int) -> None:
+        wait = self._reserve(est_tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, est_tokens: int) -> None:
+        wait = self._reserve(est_tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def reconcile(self, est_tokens: int, actual_tokens: Optional[int]) -> None:
+        if self.tokens is None or actual_tokens is None:
+            return
+        with self._lock:
+            self.tokens.credit(est_tokens - actual_tokens, time.monotonic())
+
+    def pause(self, seconds: float) -> None:
+        # Called on a 429 so that every caller, not just the failing one, backs off
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class AdaptiveConcurrency:
+    """AIMD limit on in-flight async requests.
+
+    The limit grows by roughly one slot per window of successful requests and is
+    halved on a 429; if ``target_latency`` is set, slow responses shrink it too.
+    """
+
+    def __init__(self, initial: int, maximum: int, minimum: int = 1,
+                 target_latency: Optional[float] = None):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.target_latency = target_latency
+        self.in_flight = 0
+        self._cond: Optional[asyncio.Condition] = None
+
+    def _condition(self) -> asyncio.Condition:
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    async def __aenter__(self):
+        cond = self._condition()
+        async with cond:
+            await cond.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        cond = self._condition()
+        async with cond:
+            self.in_flight -= 1
+            cond.notify_all()
+
+    def on_success(self, latency: float) -> None:
+        if self.target_latency is not None and latency > self.target_latency:
+            self.limit = max(self.minimum, self.limit * 0.9)
+        else:
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def on_rate_limited(self) -> None:
+        self.limit = max(self.minimum, self.limit / 2)
+
+
+_shared_limiter: Optional[RateLimiter] = None
+
+
+def shared_rate_limiter() -> RateLimiter:
+    global _shared_limiter
+    if _shared_limiter is None:
+        _shared_limiter = RateLimiter(rpm=RPM_LIMIT, tpm=TPM_LIMIT)
+    return _shared_limiter
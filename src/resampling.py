@@ -0,0 +1,75 @@
+from itertools import combinations
+from typing import Dict, Sequence
+
+import numpy as np
+
+# Cap on resample-matrix cells held at once; larger runs are processed in row blocks
+MAX_BLOCK_CELLS = 1 << 24
+
+
+def _blocks(n_resamples: int, n: int):
+    rows = max(1, MAX_BLOCK_CELLS // max(n, 1))
+    for start in range(0, n_resamples, rows):
+        yield min(rows, n_resamples - start)
+
+
+def bootstrap_counts(rng: np.random.Generator, rows: int, n: int) -> np.ndarray:
+    # Row r holds how often each example was drawn in resample r, so every
+    # resampled mean for every series is one matrix product
+    idx = rng.integers(0, n, size=(rows, n))
+    idx += np.arange(rows)[:, None] * n
+    return np.bincount(idx.ravel(), minlength=rows * n).reshape(rows, n).astype(np.float64)
+
+
+def pairwise_resampling(values: np.ndarray, methods: Sequence[str], metrics: Sequence[str],
+                        n_resamples: int = 10000, seed: int = 42, confidence: float = 0.95) -> Dict:
+    """Bootstrap CIs and sign-flip permutation p-values for every method pair and metric.
+
+    values has shape (metrics, methods, examples) with NaN where a score is
+    missing; each pair uses the examples where both methods have a score. The
+    statistic is the mean paired difference (second method - first).
+    """
+    n = values.shape[2]
+    pairs = list(combinations(range(len(methods)), 2))
+    diffs, masks, labels = [], [], []
+    for k, metric in enumerate(metrics):
+        for i, j in pairs:
+            d = values[k, j] - values[k, i]
+            mask = ~np.isnan(d)
+            diffs.append(np.where(mask, d, 0.0))
+            masks.append(mask.astype(np.float64))
+            labels.append((f"{methods[i]}_vs_{methods[j]}", metric))
+    if not labels or n == 0:
+        return {}
+    diffs = np.stack(diffs)  # (series, examples)
+    masks = np.stack(masks)
+    counts = masks.sum(axis=1)
+    observed = diffs.sum(axis=1) / np.maximum(counts, 1)
+
+    rng = np.random.default_rng(seed)
+    boot, extreme = [], np.zeros(len(labels))
+    for rows in _blocks(n_resamples, n):
+        weights = bootstrap_counts(rng, rows, n)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            boot.append((weights @ diffs.T) / (weights @ masks.T))
+        signs = rng.choice(np.array([-1.0, 1.0]), size=(rows, n))
+        perm = (signs @ diffs.T) / np.maximum(counts, 1)
+        extreme += (np.abs(perm) >= np.abs(observed) - 1e-12).sum(axis=0)
+    boot = np.concatenate(boot)
+
+    tail = (1 - confidence) / 2 * 100
+    low, high = np.nanpercentile(boot, [tail, 100 - tail], axis=0)
+    p_perm = (extreme + 1) / (n_resamples + 1)
+
+    out: Dict = {}
+    for s, (pair, metric) in enumerate(labels):
+        if counts[s] == 0:
+            continue
+        out.setdefault(pair, {})[metric] = {
+            "mean_diff": float(observed[s]),
+            "ci_low": float(low[s]),
+            "ci_high": float(high[s]),
+            "p_perm": float(p_perm[s]),
+            "n": int(counts[s]),
+        }
+    return out
@@ -1,9 +1,19 @@
+import argparse
+import asyncio
+import hashlib
 import json
 import os
-import time
+from dataclasses import dataclass, replace
 from datetime import datetime
+from typing import Any, Callable, Dict, Optional, Tuple
 
-from llm_utils import LLMClient, LLMConfig
+from context_budget import CONTEXT_STRATEGIES, ContextBudget
+from llm_cache import shared_response_cache
+from jsonl_io import JsonlWriter, index_path, iter_jsonl, load_index
+from llm_utils import AsyncLLMClient, LLMConfig, UsageTotals
+from prompt_layout import PROMPT_LAYOUT, PROMPT_LAYOUTS, assemble
+from rate_limit import AdaptiveConcurrency
+from structured_output import RESPONSE_FORMAT, object_schema, parse_json
 
 ROOT = os.path.dirname(os.path.dirname(__file__))
 SAMPLE_PATH = os.path.join(ROOT, "results", "sample.jsonl")
@@ -13,117 +23,463 @@ CONFIG_PATH = os.path.join(ROOT, "results", "config.json")
 MODEL_REWRITE = os.getenv("MODEL_REWRITE", "gpt-4.1")
 MODEL_JUDGE = os.getenv("MODEL_JUDGE", "gpt-4.1")
 TEMPERATURE = float(os.getenv("TEMPERATURE", "0"))
+CONCURRENCY = int(os.getenv("CONCURRENCY", "8"))
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "32"))
+TARGET_LATENCY_S = float(os.getenv("TARGET_LATENCY_S", "0")) or None
+
+METHODS = ["no_rewrite", "direct_rewrite", "always_clarify", "gated_clarify"]
+CLARIFY_STAGES = ("clarification_question", "clarification_answer", "rewrite_with_answer")
+# Optional single call replacing the two first-stage calls over the same inputs
+FUSED_STAGE = "rewrite_and_decision"
+FUSED_PARTS = ("direct_rewrite", "clarification_decision")
+
+SYSTEM_REWRITE = (
+    "You rewrite a conversational user question into a standalone question. "
+    "Preserve the user's intent and include needed context. Return JSON only."
+)
+
+SYSTEM_DECIDE = (
+    "You decide whether a clarification question is needed to preserve intent. "
+    "If multiple plausible referents or missing info exist, ask for clarification. Return JSON only."
+)
+
+SYSTEM_CLARIFY = (
+    "You ask a single concise clarification question to resolve ambiguity. "
+    "Be brief and avoid extra commentary. Return JSON only."
+)
+
+SYSTEM_ANSWER = (
+    "You are the user. Answer the clarification question concisely based on the conversation and the gold intent. "
+    "Return JSON only."
+)
+
+SYSTEM_REWRITE_WITH_ANSWER = (
+    "You rewrite the user's question into a standalone question using the clarification answer to resolve ambiguity. "
+    "Return JSON only."
+)
+
+SYSTEM_REWRITE_AND_DECIDE = (
+    "You rewrite a conversational user question into a standalone question that preserves the user's intent "
+    "and includes needed context, and you decide whether a clarification question is needed to preserve intent. "
+    "If multiple plausible referents or missing info exist, ask for clarification. Return JSON only."
+)
+
+# Stage -> system prompt; a sweep's prompt variant overrides some of these
+SYSTEM_PROMPTS = {
+    "direct_rewrite": SYSTEM_REWRITE,
+    "clarification_decision": SYSTEM_DECIDE,
+    "rewrite_and_decision": SYSTEM_REWRITE_AND_DECIDE,
+    "clarification_question": SYSTEM_CLARIFY,
+    "clarification_answer": SYSTEM_ANSWER,
+    "rewrite_with_answer": SYSTEM_REWRITE_WITH_ANSWER,
+}
+
+REWRITE_SCHEMA = object_schema({"rewrite": {"type": "string"}})
+DECISION_PROPERTIES = {
+    "needs_clarification": {"type": "boolean"},
+    "confidence": {"type": "number"},
+    "rationale": {"type": "string"},
+}
+
+# Stage -> reply schema; sent as response_format when RESPONSE_FORMAT asks for it
+# and used to repair replies locally either way
+STAGE_SCHEMAS = {
+    "direct_rewrite": REWRITE_SCHEMA,
+    "clarification_decision": object_schema(DECISION_PROPERTIES, optional=["rationale"]),
+    "rewrite_and_decision": object_schema({"rewrite": {"type": "string"}, **DECISION_PROPERTIES},
+                                          optional=["rationale"]),
+    "clarification_question": object_schema({"clarification_question": {"type": "string"}}),
+    "clarification_answer": object_schema({"user_answer": {"type": "string"}}),
+    "rewrite_with_answer": REWRITE_SCHEMA,
+}
+
+
+def load_samples(path):
+    if not os.path.exists(path):
+        raise FileNotFoundError("Run data_prep.py first to create sample.jsonl")
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f]
+
+
+def output_key(obj):
+    return obj["example_id"]
 
 
 def load_existing(path):
     data = {}
     if not os.path.exists(path):
         return data
-    with open(path, "r") as f:
-        for line in f:
-            obj = json.loads(line)
-            data[obj["example_id"]] = obj
+    for obj in iter_jsonl(path):
+        data[obj["example_id"]] = obj
     return data
 
 
-def save_append(path, obj):
-    with open(path, "a") as f:
-        f.write(json.dumps(obj, ensure_ascii=False) + "\n")
+def format_context(context_list, budget=None):
+    # (text, truncation metadata); without a budget (CONTEXT_BUDGET / --context-budget)
+    # the whole conversation is kept and the metadata is None
+    return (budget or ContextBudget()).apply(context_list)
 
 
-def format_context(context_list):
-    if not context_list:
-        return "(no prior context)"
-    # Context is alternating Q/A strings
-    lines = []
-    for i, text in enumerate(context_list):
-        role = "User" if i % 2 == 0 else "Assistant"
-        lines.append(f"{role}: {text}")
-    return "\n".join(lines)
+def get_example_id(ex):
+    return f"{ex['Conversation_no']}_{ex['Turn_no']}"
 
 
-def main():
-    if not os.path.exists(SAMPLE_PATH):
-        raise FileNotFoundError("Run data_prep.py first to create sample.jsonl")
+def shard_of(example_id, num_shards):
+    # Stable across processes and machines, unlike the salted built-in hash()
+    digest = hashlib.sha1(example_id.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % num_shards
+
 
-    with open(SAMPLE_PATH, "r") as f:
-        samples = [json.loads(line) for line in f]
+def parse_shard(spec):
+    index, _, total = spec.partition("/")
+    index, total = int(index), int(total)
+    if not 0 <= index < total:
+        raise argparse.ArgumentTypeError(f"Shard must be i/N with 0 <= i < N, got {spec}")
+    return index, total
 
-    existing = load_existing(OUTPUT_PATH)
 
-    client = LLMClient(model=MODEL_REWRITE)
-    rewrite_cfg = LLMConfig(model=MODEL_REWRITE, temperature=TEMPERATURE, max_tokens=200)
-    decision_cfg = LLMConfig(model=MODEL_REWRITE, temperature=0, max_tokens=200)
+def shard_path(path, index, total):
+    stem, ext = os.path.splitext(path)
+    return f"{stem}.shard-{index}-of-{total}{ext}"
 
-    system_rewrite = (
-        "You rewrite a conversational user question into a standalone question. "
-        "Preserve the user's intent and include needed context. Return JSON only."
+
+def merge_shards(samples, output_path, total):
+    # Canonical output keeps whatever it already had; shard records fill the rest
+    merged = load_existing(output_path)
+    sources = {example_id: "canonical" for example_id in merged}
+    duplicates = []
+    for index in range(total):
+        path = shard_path(output_path, index, total)
+        if not os.path.exists(path):
+            print(f"Missing shard file: {path}")
+            continue
+        for obj in iter_jsonl(path):
+            example_id = obj["example_id"]
+            if example_id in sources:
+                if sources[example_id] == "canonical" and merged[example_id] == obj:
+                    continue  # already merged by an earlier run
+                duplicates.append((example_id, sources[example_id], f"shard {index}"))
+                continue
+            sources[example_id] = f"shard {index}"
+            merged[example_id] = obj
+
+    expected = [get_example_id(ex) for ex in samples]
+    gaps = [example_id for example_id in expected if example_id not in merged]
+    unexpected = sorted(set(merged) - set(expected))
+
+    tmp_path = output_path + ".tmp"
+    for path in (tmp_path, index_path(tmp_path)):
+        if os.path.exists(path):
+            os.remove(path)
+    with JsonlWriter(tmp_path, fsync=True, key_fn=output_key) as writer:
+        for example_id in expected + unexpected:
+            if example_id in merged:
+                writer.write(merged[example_id])
+    os.replace(tmp_path, output_path)
+    os.replace(index_path(tmp_path), index_path(output_path))
+
+    report = {
+        "records": len(merged),
+        "expected": len(expected),
+        "duplicates": len(duplicates),
+        "gaps": len(gaps),
+        "unexpected": len(unexpected),
+    }
+    print("Merge report:", json.dumps(report))
+    for example_id, first, again in duplicates[:10]:
+        print(f"  duplicate {example_id}: kept {first}, dropped {again}")
+    if gaps:
+        print(f"  missing example_ids (first 10): {gaps[:10]}")
+    return report
+
+
+# Stage bodies follow the conversation block; prompt_layout.assemble adds it
+def rewrite_prompt(question):
+    return (
+        f"Current question: {question}\n\n"
+        "Return JSON: {\"rewrite\": "
+        "...}"  # inlined to enforce JSON-only output
     )
 
-    system_decide = (
-        "You decide whether a clarification question is needed to preserve intent. "
-        "If multiple plausible referents or missing info exist, ask for clarification. Return JSON only."
+
+def decide_prompt(question):
+    return (
+        f"Current question: {question}\n\n"
+        "Return JSON: {\"needs_clarification\": true/false, \"confidence\": 0.0-1.0, "
+        "\"rationale\": \"short\"}"
     )
 
-    system_clarify = (
-        "You ask a single concise clarification question to resolve ambiguity. "
-        "Be brief and avoid extra commentary. Return JSON only."
+
+def clarify_prompt(question):
+    return (
+        f"Current question: {question}\n\n"
+        "Return JSON: {\"clarification_question\": "
+        "...}"
     )
 
-    system_answer = (
-        "You are the user. Answer the clarification question concisely based on the conversation and the gold intent. "
-        "Return JSON only."
+
+def answer_prompt(gold, clarification_q):
+    return (
+        f"Gold intent: {gold}\n\n"
+        f"Clarification question: {clarification_q}\n\n"
+        "Return JSON: {\"user_answer\": "
+        "...}"
     )
 
-    system_rewrite_with_answer = (
-        "You rewrite the user's question into a standalone question using the clarification answer to resolve ambiguity. "
-        "Return JSON only."
+
+def rewrite_with_answer_prompt(question, clarification_q, clarification_a):
+    return (
+        f"Current question: {question}\n\n"
+        f"Clarification Q: {clarification_q}\n\nUser answer: {clarification_a}\n\n"
+        "Return JSON: {\"rewrite\": "
+        "...}"
     )
 
-    os.makedirs(os.path.dirname(OUTPUT_PATH), exist_ok=True)
 
-    for idx, ex in enumerate(samples):
-        example_id = f"{ex['Conversation_no']}_{ex['Turn_no']}"
-        if example_id in existing:
-            continue
+def rewrite_and_decide_prompt(question):
+    return (
+        f"Current question: {question}\n\n"
+        "Return JSON: {\"rewrite\": ..., \"needs_clarification\": true/false, "
+        "\"confidence\": 0.0-1.0, \"rationale\": \"short\"}"
+    )
 
-        context = format_context(ex.get("Context", []))
-        question = ex.get("Question", "")
-        gold = ex.get("Rewrite", "")
-
-        record = {
-            "example_id": example_id,
-            "conversation_no": ex.get("Conversation_no"),
-            "turn_no": ex.get("Turn_no"),
-            "context": context,
-            "question": question,
-            "gold_rewrite": gold,
-            "outputs": {},
-            "metadata": {"timestamp": datetime.now().isoformat()},
-        }
 
-        # Direct rewrite
-        user_rewrite = (
-            f"Conversation:\n{context}\n\nCurrent question: {question}\n\n"
-            "Return JSON: {\"rewrite\": "
-            "...}"  # inlined to enforce JSON-only output
+def validate_fused(data):
+    # Anything off-schema raises ValueError, which sends the example down the two-call path
+    if not isinstance(data, dict):
+        raise ValueError("fused reply is not a JSON object")
+    if not isinstance(data.get("rewrite"), str) or not data["rewrite"].strip():
+        raise ValueError("fused reply has no rewrite")
+    if not isinstance(data.get("needs_clarification"), bool):
+        raise ValueError("fused reply has no boolean needs_clarification")
+    confidence = data.get("confidence")
+    if isinstance(confidence, bool) or not isinstance(confidence, (int, float)) or not 0 <= confidence <= 1:
+        raise ValueError("fused reply has no confidence in [0, 1]")
+    if not isinstance(data.get("rationale", ""), str):
+        raise ValueError("fused reply has a non-string rationale")
+    return data
+
+
+def fused_result(resp):
+    # Split one validated fused reply into the two results the unfused stages would give;
+    # the shared call's usage is booked on direct_rewrite only
+    raw = resp["data"]
+    data = validate_fused(parse_json(raw, STAGE_SCHEMAS[FUSED_STAGE])[0] if isinstance(raw, str) else raw)
+    common = {"duration_s": resp["duration_s"], "cached": resp["cached"]}
+    return {
+        "mode": "fused",
+        "parts": {
+            "direct_rewrite": {"data": {"rewrite": data["rewrite"]}, "usage": resp["usage"], **common},
+            "clarification_decision": {
+                "data": {key: data[key] for key in ("needs_clarification", "confidence", "rationale") if key in data},
+                "usage": {},
+                **common,
+            },
+        },
+    }
+
+
+def decision_result(done):
+    if FUSED_STAGE in done:
+        return done[FUSED_STAGE]["parts"]["clarification_decision"]
+    return done["clarification_decision"]
+
+
+def new_record(ex, budget=None):
+    # Every stage and the judge see this one context, so a shared prompt prefix stays shared
+    context, truncation = format_context(ex.get("Context", []), budget)
+    record = {
+        "example_id": get_example_id(ex),
+        "conversation_no": ex.get("Conversation_no"),
+        "turn_no": ex.get("Turn_no"),
+        "context": context,
+        "question": ex.get("Question", ""),
+        "gold_rewrite": ex.get("Rewrite", ""),
+        "outputs": {},
+        "metadata": {"timestamp": datetime.now().isoformat()},
+    }
+    if truncation is not None:
+        record["metadata"]["context"] = truncation
+    return record
+
+
+@dataclass
+class Stage:
+    deps: Tuple[str, ...]
+    system: str
+    prompt: Callable[[Dict[str, Any], Dict[str, Any]], str]
+    config: LLMConfig
+    # Optional guard evaluated on the dependency results; False skips the stage
+    when: Optional[Callable[[Dict[str, Any], Dict[str, Any]], bool]] = None
+    layout: str = PROMPT_LAYOUT
+    # Set on the fused stage: the separate stages to fall back to if its reply is unusable
+    parts: Optional[Dict[str, "Stage"]] = None
+
+    def render(self, rec, done):
+        # (system, user) messages; the conversation always precedes the stage body
+        return assemble(self.layout, self.system, rec["context"], self.prompt(rec, done))
+
+
+def should_run(stage, rec, done):
+    # A stage is skipped when any dependency was skipped or its guard says no
+    if any(out is None for out in done.values()):
+        return False
+    return stage.when is None or stage.when(rec, done)
+
+
+def stage_configs(model, temperature):
+    # The clarification decision is always greedy; the other stages use the run temperature
+    rewrite_cfg = LLMConfig(model=model, temperature=temperature, max_tokens=200)
+    decision_cfg = LLMConfig(model=model, temperature=0, max_tokens=200)
+    return rewrite_cfg, decision_cfg
+
+
+def parse_methods(text):
+    methods = [m.strip() for m in text.split(",") if m.strip()]
+    unknown = sorted(set(methods) - set(METHODS))
+    if unknown:
+        raise ValueError(f"Unknown methods: {unknown}")
+    return methods
+
+
+def build_stages(rewrite_cfg, decision_cfg, methods=METHODS, prompts=None, layout=PROMPT_LAYOUT, fused=False):
+    unknown = sorted(set(prompts or {}) - set(SYSTEM_PROMPTS))
+    if unknown:
+        raise ValueError(f"Unknown stages in prompt overrides: {unknown}")
+    systems = {**SYSTEM_PROMPTS, **(prompts or {})}
+
+    # Stage prompts see the record and the results of their dependencies only
+    stages = {
+        "direct_rewrite": Stage(
+            (), systems["direct_rewrite"],
+            lambda rec, done: rewrite_prompt(rec["question"]),
+            rewrite_cfg,
+        ),
+        "clarification_decision": Stage(
+            (), systems["clarification_decision"],
+            lambda rec, done: decide_prompt(rec["question"]),
+            decision_cfg,
+        ),
+        "clarification_question": Stage(
+            (), systems["clarification_question"],
+            lambda rec, done: clarify_prompt(rec["question"]),
+            rewrite_cfg,
+        ),
+        "clarification_answer": Stage(
+            ("clarification_question",), systems["clarification_answer"],
+            lambda rec, done: answer_prompt(
+                rec["gold_rewrite"],
+                done["clarification_question"]["data"]["clarification_question"],
+            ),
+            rewrite_cfg,
+        ),
+        "rewrite_with_answer": Stage(
+            ("clarification_question", "clarification_answer"), systems["rewrite_with_answer"],
+            lambda rec, done: rewrite_with_answer_prompt(
+                rec["question"],
+                done["clarification_question"]["data"]["clarification_question"],
+                done["clarification_answer"]["data"]["user_answer"],
+            ),
+            rewrite_cfg,
+        ),
+    }
+
+    needed = set()
+    if "direct_rewrite" in methods or "gated_clarify" in methods:
+        needed.add("direct_rewrite")
+    if "gated_clarify" in methods:
+        needed.add("clarification_decision")
+    if "always_clarify" in methods or "gated_clarify" in methods:
+        needed.update(CLARIFY_STAGES)
+
+    decision = "clarification_decision"
+    if fused and set(FUSED_PARTS) <= needed:
+        # Same inputs, one request; the decision shares the rewrite's sampling config
+        stages[FUSED_STAGE] = Stage(
+            (), systems[FUSED_STAGE],
+            lambda rec, done: rewrite_and_decide_prompt(rec["question"]),
+            LLMConfig(model=rewrite_cfg.model, temperature=rewrite_cfg.temperature,
+                      max_tokens=rewrite_cfg.max_tokens + decision_cfg.max_tokens, top_p=rewrite_cfg.top_p),
+            parts={name: stages[name] for name in FUSED_PARTS},
+        )
+        needed = (needed - set(FUSED_PARTS)) | {FUSED_STAGE}
+        decision = FUSED_STAGE
+
+    if "gated_clarify" in methods and "always_clarify" not in methods:
+        # Lazy gating: only ask (and answer) a clarification when the decision says so
+        stages["clarification_question"].deps = (decision,)
+        stages["clarification_question"].when = (
+            lambda rec, done: bool(decision_result(done)["data"]["needs_clarification"])
         )
-        resp = client.chat_json(system_rewrite, user_rewrite, rewrite_cfg)
-        record["outputs"]["direct_rewrite"] = {
+    for name, stage in stages.items():
+        stage.layout = layout
+        stage.config = replace(stage.config, schema=STAGE_SCHEMAS[name], schema_name=name)
+    return {name: stage for name, stage in stages.items() if name in needed}
+
+
+def stage_levels(stages):
+    # Topological layers: every stage in a layer only depends on earlier layers
+    levels = []
+    placed = set()
+    while len(placed) < len(stages):
+        level = [name for name, stage in stages.items()
+                 if name not in placed and all(dep in placed for dep in stage.deps)]
+        if not level:
+            raise ValueError("Stage dependencies contain a cycle")
+        levels.append(level)
+        placed.update(level)
+    return levels
+
+
+async def run_dag(stages, call):
+    # Each stage starts as soon as its own dependencies finish
+    tasks = {}
+
+    async def run_stage(name):
+        done = {dep: await tasks[dep] for dep in stages[name].deps}
+        return await call(name, done)
+
+    for name in stages:
+        tasks[name] = asyncio.ensure_future(run_stage(name))
+    try:
+        results = await asyncio.gather(*tasks.values())
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        raise
+    return dict(zip(tasks, results))
+
+
+def fill_outputs(record, done, methods=METHODS):
+    computed = [name for name, out in done.items() if out is not None]
+    fused = done.get(FUSED_STAGE)
+    if fused is not None:
+        done = {**done, **fused["parts"]}
+        if fused["mode"] == "fallback":
+            computed += list(fused["parts"])
+        # "fused" or "fallback" (fused reply failed validation), vs "separate" calls
+        record["metadata"]["first_stage"] = fused["mode"]
+    elif any(done.get(name) is not None for name in FUSED_PARTS):
+        record["metadata"]["first_stage"] = "separate"
+
+    resp = done.get("direct_rewrite")
+    dec = done.get("clarification_decision")
+    clarify = done.get("clarification_question")
+    answer = done.get("clarification_answer")
+    rewrite2 = done.get("rewrite_with_answer")
+
+    outputs = record["outputs"]
+    if resp is not None:
+        outputs["direct_rewrite"] = {
             "rewrite": resp["data"]["rewrite"],
             "usage": resp["usage"],
             "duration_s": resp["duration_s"],
         }
 
-        # Clarification decision
-        user_decide = (
-            f"Conversation:\n{context}\n\nCurrent question: {question}\n\n"
-            "Return JSON: {\"needs_clarification\": true/false, \"confidence\": 0.0-1.0, "
-            "\"rationale\": \"short\"}"
-        )
-        dec = client.chat_json(system_decide, user_decide, decision_cfg)
+    needs_clarify = False
+    if dec is not None:
         needs_clarify = bool(dec["data"]["needs_clarification"])
-        record["outputs"]["clarification_decision"] = {
+        outputs["clarification_decision"] = {
             "needs_clarification": needs_clarify,
             "confidence": dec["data"]["confidence"],
             "rationale": dec["data"].get("rationale", ""),
@@ -131,78 +487,301 @@ def main():
             "duration_s": dec["duration_s"],
         }
 
-        # Always-clarify path
-        user_clarify = (
-            f"Conversation:\n{context}\n\nCurrent question: {question}\n\n"
-            "Return JSON: {\"clarification_question\": "
-            "...}"
-        )
-        clarify = client.chat_json(system_clarify, user_clarify, rewrite_cfg)
+    if rewrite2 is not None:
         clarification_q = clarify["data"]["clarification_question"]
-
-        user_answer = (
-            f"Conversation:\n{context}\n\nGold intent: {gold}\n\n"
-            f"Clarification question: {clarification_q}\n\n"
-            "Return JSON: {\"user_answer\": "
-            "...}"
-        )
-        answer = client.chat_json(system_answer, user_answer, rewrite_cfg)
         clarification_a = answer["data"]["user_answer"]
+        if "always_clarify" in methods:
+            outputs["always_clarify"] = {
+                "clarification_question": clarification_q,
+                "clarification_answer": clarification_a,
+                "rewrite": rewrite2["data"]["rewrite"],
+                "usage": {
+                    "clarify": clarify["usage"],
+                    "answer": answer["usage"],
+                    "rewrite": rewrite2["usage"],
+                },
+            }
 
-        user_rewrite2 = (
-            f"Conversation:\n{context}\n\nCurrent question: {question}\n\n"
-            f"Clarification Q: {clarification_q}\n\nUser answer: {clarification_a}\n\n"
-            "Return JSON: {\"rewrite\": "
-            "...}"
-        )
-        rewrite2 = client.chat_json(system_rewrite_with_answer, user_rewrite2, rewrite_cfg)
-        record["outputs"]["always_clarify"] = {
-            "clarification_question": clarification_q,
-            "clarification_answer": clarification_a,
-            "rewrite": rewrite2["data"]["rewrite"],
-            "usage": {
-                "clarify": clarify["usage"],
-                "answer": answer["usage"],
-                "rewrite": rewrite2["usage"],
-            },
-        }
-
-        # Gated-clarify path
+    # Gated-clarify path
+    if "gated_clarify" in methods:
         if needs_clarify:
-            record["outputs"]["gated_clarify"] = {
+            outputs["gated_clarify"] = {
                 "clarification_question": clarification_q,
                 "clarification_answer": clarification_a,
                 "rewrite": rewrite2["data"]["rewrite"],
                 "used_clarification": True,
             }
         else:
-            record["outputs"]["gated_clarify"] = {
-                "rewrite": record["outputs"]["direct_rewrite"]["rewrite"],
+            outputs["gated_clarify"] = {
+                "rewrite": outputs["direct_rewrite"]["rewrite"],
                 "used_clarification": False,
             }
 
-        # No-rewrite baseline
-        record["outputs"]["no_rewrite"] = {"rewrite": question}
+    # No-rewrite baseline
+    if "no_rewrite" in methods:
+        outputs["no_rewrite"] = {"rewrite": record["question"]}
 
-        save_append(OUTPUT_PATH, record)
-        if (idx + 1) % 10 == 0:
-            print(f"Processed {idx+1}/{len(samples)}")
+    record["metadata"]["methods"] = [m for m in METHODS if m in methods]
+    record["metadata"]["computed_stages"] = computed
+    return record
 
-        time.sleep(0.2)
 
-    # Save config for reproducibility
+async def run_fused(client, stage, record, done):
+    # chat_text so an off-schema reply is not retried as a transport error
+    resp = await client.chat_text(*stage.render(record, done), stage.config)
+    try:
+        return fused_result(resp)
+    except ValueError:
+        parts = await asyncio.gather(*(
+            client.chat_json(*part.render(record, done), part.config) for part in stage.parts.values()
+        ))
+        return {"mode": "fallback", "parts": dict(zip(stage.parts, parts))}
+
+
+async def process_example(client, ex, stages, methods=METHODS, budget=None):
+    record = new_record(ex, budget)
+
+    async def call(name, done):
+        stage = stages[name]
+        if not should_run(stage, record, done):
+            return None
+        if stage.parts:
+            return await run_fused(client, stage, record, done)
+        return await client.chat_json(*stage.render(record, done), stage.config)
+
+    return fill_outputs(record, await run_dag(stages, call), methods)
+
+
+async def run_async(samples, existing, writer, client, stages, concurrency, methods=METHODS, label="",
+                    budget=None):
+    pending = iter([ex for ex in samples if get_example_id(ex) not in existing])
+    total = len(samples)
+    done = [len(existing)]
+
+    # Workers share one iterator, so at most `concurrency` examples are in flight
+    async def worker():
+        for ex in pending:
+            record = await process_example(client, ex, stages, methods, budget)
+            writer.write(record)
+            done[0] += 1
+            if done[0] % 10 == 0:
+                print(f"{label}Processed {done[0]}/{total}")
+
+    await asyncio.gather(*(worker() for _ in range(max(concurrency, 1))))
+
+
+def resolve_fused_batch(records, stage, requests, wave_results, backend, name, usage):
+    from batch_utils import run_batch
+
+    # Valid fused replies are split in place; the rest go out as one batch of
+    # separate first-stage requests. Examples still incomplete stay pending.
+    resolved, fallback = {}, []
+    for custom_id, *_ in requests:
+        example_id, _, stage_name = custom_id.rpartition(":")
+        if stage_name != FUSED_STAGE:
+            continue
+        try:
+            resolved[custom_id] = fused_result(wave_results[custom_id])
+        except (KeyError, ValueError):
+            rec = records[example_id]
+            for part_name, part in stage.parts.items():
+                fallback.append((f"{example_id}:{part_name}", *part.render(rec, {}), part.config))
+    if fallback:
+        part_results = run_batch(fallback, backend, name)
+        for resp in part_results.values():
+            if not resp["cached"]:
+                usage.add(resp["usage"])
+        for example_id in dict.fromkeys(cid.rpartition(":")[0] for cid, *_ in fallback):
+            parts = {part: part_results.get(f"{example_id}:{part}") for part in stage.parts}
+            if all(parts.values()):
+                resolved[f"{example_id}:{FUSED_STAGE}"] = {"mode": "fallback", "parts": parts}
+    # Unresolved fused ids must not look like finished (parsed) results
+    for custom_id, *_ in requests:
+        if custom_id.endswith(f":{FUSED_STAGE}") and custom_id not in resolved:
+            wave_results.pop(custom_id, None)
+    return resolved
+
+
+def run_batch_mode(samples, existing, writer, backend, stages, methods=METHODS, budget=None):
+    from batch_utils import batch_scope, run_batch
+
+    scope = batch_scope(writer.path)
+    records = {}
+    for ex in samples:
+        example_id = get_example_id(ex)
+        if example_id not in existing:
+            records[example_id] = new_record(ex, budget)
+
+    # Dependent stages need earlier answers, so each DAG layer is its own batch.
+    # Skipped stages are stored as None; failed requests are simply absent.
+    results = {}
+    usage = UsageTotals()
+    for wave, level in enumerate(stage_levels(stages), start=1):
+        requests = []
+        for example_id, rec in records.items():
+            for name in level:
+                stage = stages[name]
+                if any(f"{example_id}:{dep}" not in results for dep in stage.deps):
+                    continue
+                done = {dep: results[f"{example_id}:{dep}"] for dep in stage.deps}
+                if not should_run(stage, rec, done):
+                    results[f"{example_id}:{name}"] = None
+                    continue
+                requests.append((f"{example_id}:{name}", *stage.render(rec, done), stage.config))
+        wave_results = run_batch(requests, backend, f"{scope}-rewrite-wave{wave}")
+        for resp in wave_results.values():
+            if not resp["cached"]:
+                usage.add(resp["usage"])
+        if FUSED_STAGE in level:
+            wave_results.update(resolve_fused_batch(
+                records, stages[FUSED_STAGE], requests, wave_results, backend, f"{scope}-rewrite-wave{wave}-fallback", usage,
+            ))
+        results.update(wave_results)
+
+    written = 0
+    for example_id, rec in records.items():
+        # Incomplete examples stay pending and are picked up by the next run
+        if any(f"{example_id}:{name}" not in results for name in stages):
+            continue
+        done = {name: results[f"{example_id}:{name}"] for name in stages}
+        writer.write(fill_outputs(rec, done, methods))
+        written += 1
+    print(f"Batch mode wrote {written}/{len(records)} pending examples")
+    return usage
+
+
+def add_context_args(parser):
+    defaults = ContextBudget()
+    parser.add_argument("--context-budget", type=int, default=defaults.max_tokens, metavar="TOKENS",
+                        help="cap the conversation sent with every request at this many tokens (0 = no cap)")
+    parser.add_argument("--context-strategy", choices=sorted(CONTEXT_STRATEGIES), default=defaults.strategy,
+                        help="how to get under the budget: truncate older answers, drop them keeping user "
+                             "turns, and/or drop the oldest turns (auto = in that order)")
+    parser.add_argument("--context-turns", type=int, default=defaults.keep_turns, metavar="K",
+                        help="always keep only the last K context turns (0 = all)")
+    parser.add_argument("--context-answer-tokens", type=int, default=defaults.answer_tokens,
+                        help="length older assistant answers are truncated to")
+
+
+def context_budget(args):
+    return ContextBudget(args.context_budget, args.context_strategy, args.context_turns, args.context_answer_tokens)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run rewrite and clarification experiments")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY,
+                        help="initial number of requests in flight")
+    parser.add_argument("--max-concurrency", type=int, default=MAX_CONCURRENCY,
+                        help="ceiling the adaptive controller may ramp up to")
+    parser.add_argument("--target-latency", type=float, default=TARGET_LATENCY_S,
+                        help="shrink concurrency when responses are slower than this (seconds)")
+    parser.add_argument("--samples", default=SAMPLE_PATH, help="input sample.jsonl")
+    parser.add_argument("--output", default=OUTPUT_PATH, help="output llm_outputs.jsonl")
+    parser.add_argument("--config", default=CONFIG_PATH, help="where to write the run config")
+    parser.add_argument("--batch", choices=["openai", "local"],
+                        help="submit all pending requests through a batch backend instead of live calls")
+    parser.add_argument("--prompt-layout", choices=PROMPT_LAYOUTS, default=PROMPT_LAYOUT,
+                        help="'shared' gives every stage the same system + conversation prefix "
+                             "so provider prefix caching applies (see prompt_layout.py)")
+    parser.add_argument("--fused-first-stage", action="store_true",
+                        help="ask for the direct rewrite and the clarification decision in one request, "
+                             "falling back to two calls when the reply does not validate")
+    parser.add_argument("--methods", default=",".join(METHODS),
+                        help="comma-separated methods to produce; without always_clarify the "
+                             "clarification calls only run when gated_clarify needs them")
+    parser.add_argument("--shard", type=parse_shard, metavar="i/N",
+                        help="only run examples whose example_id hashes to shard i of N; "
+                             "writes to a per-shard output file")
+    parser.add_argument("--merge-shards", type=int, metavar="N",
+                        help="merge the N shard files into --output, reporting duplicates and gaps")
+    parser.add_argument("--rerun", default="",
+                        help="comma-separated example_ids to recompute even if already written; "
+                             "the new record supersedes the old one")
+    add_context_args(parser)
+    parser.add_argument("--no-cache", action="store_true", help="bypass the on-disk response cache")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    samples = load_samples(args.samples)
+
+    if args.merge_shards:
+        merge_shards(samples, args.output, args.merge_shards)
+        return
+
+    if args.shard:
+        index, total = args.shard
+        samples = [ex for ex in samples if shard_of(get_example_id(ex), total) == index]
+        args.output = shard_path(args.output, index, total)
+        args.config = shard_path(args.config, index, total)
+
+    # Resume from the sidecar index (example_id -> byte offset) instead of reparsing
+    existing = load_index(args.output, output_key)
+    for example_id in filter(None, (x.strip() for x in args.rerun.split(","))):
+        existing.pop(example_id, None)
+
+    cache = shared_response_cache()
+    if args.no_cache:
+        cache.enabled = False
+
+    rewrite_cfg, decision_cfg = stage_configs(MODEL_REWRITE, TEMPERATURE)
+    methods = parse_methods(args.methods)
+    budget = context_budget(args)
+    stages = build_stages(rewrite_cfg, decision_cfg, methods, layout=args.prompt_layout,
+                          fused=args.fused_first_stage)
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+
     config = {
         "model_rewrite": MODEL_REWRITE,
         "model_judge": MODEL_JUDGE,
         "temperature": TEMPERATURE,
         "sample_size": len(samples),
-        "timestamp": datetime.now().isoformat(),
+        "methods": methods,
+        "prompt_layout": args.prompt_layout,
+        "fused_first_stage": args.fused_first_stage,
+        "response_format": RESPONSE_FORMAT,
+        "context_budget": budget.describe(),
+        "shard": "/".join(map(str, args.shard)) if args.shard else None,
     }
-    with open(CONFIG_PATH, "w") as f:
+
+    with JsonlWriter(args.output, key_fn=output_key) as writer:
+        if args.batch:
+            from batch_utils import get_batch_backend
+
+            usage = run_batch_mode(samples, existing, writer, get_batch_backend(args.batch), stages, methods,
+                                   budget)
+            config["batch_backend"] = args.batch
+        else:
+            # Rate budgets come from RPM_LIMIT / TPM_LIMIT via the shared limiter
+            controller = AdaptiveConcurrency(
+                initial=args.concurrency,
+                maximum=max(args.max_concurrency, args.concurrency),
+                target_latency=args.target_latency,
+            )
+            client = AsyncLLMClient(model=MODEL_REWRITE, concurrency=controller)
+
+            # One worker per potential slot; the controller decides how many are active
+            asyncio.run(run_async(samples, existing, writer, client, stages, controller.maximum, methods,
+                                  budget=budget))
+            config["concurrency"] = args.concurrency
+            config["max_concurrency"] = controller.maximum
+            config["final_concurrency_limit"] = int(controller.limit)
+            config["repaired_replies"] = client.repaired_replies
+            usage = client.usage
+
+    # Save config for reproducibility
+    config["response_cache"] = cache.stats()
+    config["prompt_cache"] = usage.stats()
+    print("Prompt prefix cache:", json.dumps(config["prompt_cache"]))
+    config["timestamp"] = datetime.now().isoformat()
+    with open(args.config, "w") as f:
         json.dump(config, f, indent=2)
 
-    print("Wrote:", OUTPUT_PATH)
-    print("Wrote:", CONFIG_PATH)
+    print("Wrote:", args.output)
+    print("Wrote:", args.config)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,110 @@
+import json
+import os
+import re
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+# "off" sends no response_format (the published setup), "json_object" asks for
+# JSON mode, "json_schema" sends each call site's schema for strict decoding.
+# Replies are repaired locally in every mode.
+RESPONSE_FORMATS = ("off", "json_object", "json_schema")
+RESPONSE_FORMAT = os.getenv("RESPONSE_FORMAT", "off")
+
+FENCE_RE = re.compile(r"```[\w-]*[ \t]*\n?(.*?)```", re.S)
+TRUE_WORDS = ("true", "yes")
+FALSE_WORDS = ("false", "no")
+
+
+def object_schema(properties: Dict[str, Any], optional: Iterable[str] = ()) -> Dict[str, Any]:
+    # "required" lists the keys a reply must have to be used; strict_schema marks
+    # every property required for the provider
+    optional = set(optional)
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": [key for key in properties if key not in optional],
+        "additionalProperties": False,
+    }
+
+
+def strict_schema(schema: Dict[str, Any]) -> Dict[str, Any]:
+    # Strict mode wants every property required and no extras
+    if schema.get("type") != "object":
+        return schema
+    properties = {key: strict_schema(value) for key, value in schema.get("properties", {}).items()}
+    return {**schema, "properties": properties, "required": list(properties)}
+
+
+def response_format(name: str, schema: Optional[Dict[str, Any]],
+                    mode: str = RESPONSE_FORMAT) -> Optional[Dict[str, Any]]:
+    if mode == "off" or schema is None:
+        return None
+    if mode == "json_object":
+        return {"type": "json_object"}
+    if mode == "json_schema":
+        return {"type": "json_schema", "json_schema": {"name": name, "schema": strict_schema(schema), "strict": True}}
+    raise ValueError(f"Unknown RESPONSE_FORMAT {mode!r}; expected one of {RESPONSE_FORMATS}")
+
+
+def extract_json(content: str) -> Any:
+    """Recover the first JSON object from a reply wrapped in code fences or prose."""
+    text = content or ""
+    fence = FENCE_RE.search(text)
+    if fence:
+        try:
+            return json.loads(fence.group(1))
+        except json.JSONDecodeError:
+            text = fence.group(1)
+    decoder = json.JSONDecoder()
+    for match in re.finditer(r"\{", text):
+        try:
+            return decoder.raw_decode(text, match.start())[0]
+        except json.JSONDecodeError:
+            continue
+    raise ValueError("reply contains no JSON object")
+
+
+def coerce(value: Any, schema: Optional[Dict[str, Any]]) -> Any:
+    """Convert scalars to the schema's types where unambiguous, e.g. "0.8" -> 0.8."""
+    if not schema:
+        return value
+    kind = schema.get("type")
+    if kind == "object" and isinstance(value, dict):
+        properties = schema.get("properties", {})
+        return {key: coerce(item, properties.get(key)) for key, item in value.items()}
+    if isinstance(value, str) and kind in ("boolean", "number", "integer"):
+        text = value.strip().lower()
+        if kind == "boolean":
+            if text in TRUE_WORDS:
+                return True
+            if text in FALSE_WORDS:
+                return False
+            return value
+        try:
+            number = float(text)
+        except ValueError:
+            return value
+        value = number
+    if kind == "integer" and isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def parse_json(content: str, schema: Optional[Dict[str, Any]] = None) -> Tuple[Any, bool]:
+    """Return (data, repaired); raises ValueError when no JSON object can be recovered
+    or the object lacks a key the schema requires."""
+    try:
+        data = json.loads(content)
+        repaired = False
+    except (TypeError, json.JSONDecodeError):
+        data = extract_json(content)
+        repaired = True
+    if schema is not None:
+        if schema.get("type") == "object" and not isinstance(data, dict):
+            raise ValueError("reply is not a JSON object")
+        coerced = coerce(data, schema)
+        repaired = repaired or coerced != data
+        data = coerced
+        missing = [key for key in schema.get("required", ()) if key not in data]
+        if missing:
+            raise ValueError(f"reply is missing {', '.join(missing)}")
+    return data, repaired
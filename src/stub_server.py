@@ -0,0 +1,185 @@
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Minimal OpenAI-compatible /chat/completions endpoint for exercising the
+# runners without network access or API spend:
+#   python src/stub_server.py --port 8000
+#   OPENAI_API_KEY=stub OPENAI_BASE_URL=http://127.0.0.1:8000/v1 python src/run_experiments.py
+
+JSON_KEYS_RE = re.compile(r"Return JSON: (\{.*)", re.S)
+KEY_RE = re.compile(r"\"(\w+)\":")
+QUESTION_RE = re.compile(r"Current question: (.*)")
+CANDIDATE_RE = re.compile(r"Candidate rewrite: (.*)")
+MULTI_CANDIDATE_RE = re.compile(r"^\[([A-Z])\] (.*)$", re.M)
+
+
+def _stable_flag(text):
+    return int(hashlib.sha1(text.encode("utf-8")).hexdigest(), 16) % 2 == 0
+
+
+def _stable_score(text):
+    # Depends only on the candidate, so single- and multi-candidate judging agree
+    return 1 + int(hashlib.sha1(text.encode("utf-8")).hexdigest(), 16) % 5
+
+
+def fake_value(key, user):
+    question = QUESTION_RE.search(user)
+    question = question.group(1).strip() if question else "the question"
+    if key == "rewrite":
+        return f"Standalone: {question}"
+    if key == "needs_clarification":
+        return _stable_flag(user)
+    if key == "confidence":
+        return 0.5
+    if key == "score":
+        candidate = CANDIDATE_RE.search(user)
+        return _stable_score(candidate.group(1).strip()) if candidate else 4
+    if key == "clarification_question":
+        return f"What do you mean by '{question}'?"
+    if key == "user_answer":
+        return "I mean the topic we were just discussing."
+    return "stub"
+
+
+def fake_content(user):
+    match = JSON_KEYS_RE.search(user)
+    if not match:
+        return "stub response"
+    candidates = MULTI_CANDIDATE_RE.findall(user)
+    if candidates:
+        return json.dumps({label: {"score": _stable_score(text.strip()), "rationale": "stub"}
+                           for label, text in candidates})
+    keys = KEY_RE.findall(match.group(1))
+    return json.dumps({key: fake_value(key, user) for key in keys})
+
+
+class PrefixCache:
+    # Mimics provider prompt caching: once seen, a prompt prefix of at least
+    # min_tokens is reported as cached, in block_tokens increments
+    def __init__(self, min_tokens=1024, block_tokens=128):
+        self.min_tokens = min_tokens
+        self.block_tokens = block_tokens
+        self.seen = set()
+        self.lock = threading.Lock()
+
+    def lookup(self, model, messages):
+        text = "".join(f"{m.get('role')}\0{m.get('content', '')}\0" for m in messages)
+        n_tokens = len(text) // 4
+        cached = 0
+        matching = True
+        with self.lock:
+            for tokens in range(max(self.min_tokens, 1), n_tokens + 1, self.block_tokens):
+                key = hashlib.sha1(f"{model}\0{text[:tokens * 4]}".encode("utf-8")).digest()
+                if matching and key in self.seen:
+                    cached = tokens
+                else:
+                    matching = False
+                self.seen.add(key)
+        return cached
+
+
+PREFIX_CACHE = PrefixCache()
+
+
+def malformed(content):
+    # The usual ways a model breaks "JSON only": a code fence, surrounding prose and
+    # numbers or booleans sent as strings
+    try:
+        data = json.loads(content)
+    except json.JSONDecodeError:
+        return content
+    if isinstance(data, dict):
+        data = {key: json.dumps(value) if isinstance(value, (bool, int, float)) else value
+                for key, value in data.items()}
+    return f"Here is the result:\n```json\n{json.dumps(data, indent=2)}\n```"
+
+
+def completion(body, malformed_rate=0.0):
+    messages = body.get("messages", [])
+    user = messages[-1]["content"] if messages else ""
+    content = fake_content(user)
+    if random.random() < malformed_rate:
+        content = malformed(content)
+    cached_tokens = PREFIX_CACHE.lookup(body.get("model", "stub"), messages)
+    prompt_tokens = sum(len(m.get("content", "")) for m in messages) // 4
+    completion_tokens = len(content) // 4
+    return {
+        "id": "chatcmpl-stub",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "stub"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": min(cached_tokens, prompt_tokens)},
+        },
+    }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+    error_rate = 0.0
+    malformed_rate = 0.0
+
+    def _send(self, status, payload, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.endswith("/chat/completions"):
+            self._send(404, {"error": {"message": f"unknown path {self.path}"}})
+            return
+        time.sleep(self.latency)
+        if random.random() < self.error_rate:
+            self._send(429, {"error": {"message": "stub rate limit", "type": "rate_limit_error"}},
+                       headers={"Retry-After": "1"})
+            return
+        self._send(200, completion(body, self.malformed_rate))
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible stub server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds to sleep per request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--malformed-rate", type=float, default=0.0,
+                        help="fraction of replies fenced, wrapped in prose and with stringified scalars")
+    parser.add_argument("--prefix-cache-min-tokens", type=int, default=1024,
+                        help="shortest prompt prefix reported as cached once seen")
+    args = parser.parse_args()
+
+    PREFIX_CACHE.min_tokens = args.prefix_cache_min_tokens
+    StubHandler.latency = args.latency
+    StubHandler.error_rate = args.error_rate
+    StubHandler.malformed_rate = args.malformed_rate
+    server = ThreadingHTTPServer((args.host, args.port), StubHandler)
+    print(f"Stub server listening on http://{args.host}:{args.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
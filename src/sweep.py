@@ -0,0 +1,186 @@
+import argparse
+import asyncio
+import json
+import os
+import re
+from datetime import datetime
+
+from jsonl_io import JsonlWriter, load_index
+from llm_cache import shared_response_cache
+from llm_utils import AsyncLLMClient
+from prompt_layout import PROMPT_LAYOUT, PROMPT_LAYOUTS
+from rate_limit import AdaptiveConcurrency
+from structured_output import RESPONSE_FORMAT
+from run_experiments import (
+    CONCURRENCY,
+    MAX_CONCURRENCY,
+    METHODS,
+    MODEL_JUDGE,
+    ROOT,
+    SAMPLE_PATH,
+    SYSTEM_PROMPTS,
+    TARGET_LATENCY_S,
+    add_context_args,
+    build_stages,
+    context_budget,
+    load_samples,
+    output_key,
+    parse_methods,
+    run_async,
+    stage_configs,
+)
+
+SWEEP_DIR = os.path.join(ROOT, "results", "sweeps")
+
+
+def cell_name(model, temperature, variant):
+    slug = re.sub(r"[^\w.-]+", "_", model)
+    return f"{slug}__t{temperature:g}__{variant}"
+
+
+def load_variants(path):
+    # {"variant": {"stage": "system prompt", ...}, ...}; unlisted stages keep the defaults
+    if not path:
+        return {"default": {}}
+    with open(path) as f:
+        variants = json.load(f)
+    for name, prompts in variants.items():
+        if not re.fullmatch(r"[\w.-]+", name):
+            raise ValueError(f"Prompt variant names must be file-name safe: {name!r}")
+        unknown = sorted(set(prompts) - set(SYSTEM_PROMPTS))
+        if unknown:
+            raise ValueError(f"Unknown stages in variant {name!r}: {unknown}")
+    return variants
+
+
+def parse_list(text, cast=str):
+    return [cast(x.strip()) for x in text.split(",") if x.strip()]
+
+
+async def run_cell(cell, samples, client, controller, methods, layout, fused, budget):
+    rewrite_cfg, decision_cfg = stage_configs(cell["model"], cell["temperature"])
+    stages = build_stages(rewrite_cfg, decision_cfg, methods, cell["prompts"], layout, fused)
+    os.makedirs(cell["dir"], exist_ok=True)
+    output = os.path.join(cell["dir"], "llm_outputs.jsonl")
+
+    existing = load_index(output, output_key)
+    with JsonlWriter(output, key_fn=output_key) as writer:
+        await run_async(samples, existing, writer, client, stages, controller.maximum, methods,
+                        label=f"[{cell['name']}] ", budget=budget)
+
+    config = {
+        "cell": cell["name"],
+        "model_rewrite": cell["model"],
+        "model_judge": MODEL_JUDGE,
+        "temperature": cell["temperature"],
+        "prompt_variant": cell["variant"],
+        "prompt_layout": layout,
+        "fused_first_stage": fused,
+        "context_budget": budget.describe(),
+        "system_prompts": {name: stage.system for name, stage in stages.items()},
+        "sample_size": len(samples),
+        "methods": methods,
+        "timestamp": datetime.now().isoformat(),
+    }
+    with open(os.path.join(cell["dir"], "config.json"), "w") as f:
+        json.dump(config, f, indent=2)
+
+
+async def run_sweep(cells, samples, client, controller, methods, layout, fused, budget):
+    # Every cell shares one client, so the rate limiter, concurrency controller,
+    # response cache and in-flight deduplication all span the whole grid
+    await asyncio.gather(*(
+        run_cell(cell, samples, client, controller, methods, layout, fused, budget) for cell in cells
+    ))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run experiments over a grid of models, temperatures and prompts")
+    parser.add_argument("--models", required=True, help="comma-separated rewrite models")
+    parser.add_argument("--temperatures", default="0", help="comma-separated sampling temperatures")
+    parser.add_argument("--prompt-variants", metavar="JSON",
+                        help='file mapping variant names to system prompt overrides, e.g. '
+                             '{"terse": {"direct_rewrite": "..."}}')
+    parser.add_argument("--prompt-layout", choices=PROMPT_LAYOUTS, default=PROMPT_LAYOUT,
+                        help="'shared' keeps one system + conversation prefix across stages for prefix caching")
+    parser.add_argument("--fused-first-stage", action="store_true",
+                        help="one request for the direct rewrite and clarification decision in every cell")
+    parser.add_argument("--methods", default=",".join(METHODS))
+    parser.add_argument("--samples", default=SAMPLE_PATH)
+    parser.add_argument("--output-dir", default=SWEEP_DIR,
+                        help="cells are written to <output-dir>/<model>__t<temperature>__<variant>/")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY,
+                        help="initial number of requests in flight across all cells")
+    parser.add_argument("--max-concurrency", type=int, default=MAX_CONCURRENCY,
+                        help="upper bound for the shared adaptive concurrency limit")
+    parser.add_argument("--target-latency", type=float, default=TARGET_LATENCY_S,
+                        help="shrink concurrency when responses are slower than this (seconds)")
+    add_context_args(parser)
+    parser.add_argument("--no-cache", action="store_true", help="bypass the on-disk response cache")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    samples = load_samples(args.samples)
+    methods = parse_methods(args.methods)
+    models = parse_list(args.models)
+    temperatures = parse_list(args.temperatures, float)
+    variants = load_variants(args.prompt_variants)
+
+    cells = []
+    for model in models:
+        for temperature in temperatures:
+            for variant, prompts in variants.items():
+                name = cell_name(model, temperature, variant)
+                cells.append({
+                    "name": name,
+                    "dir": os.path.join(args.output_dir, name),
+                    "model": model,
+                    "temperature": temperature,
+                    "variant": variant,
+                    "prompts": prompts,
+                })
+
+    cache = shared_response_cache()
+    if args.no_cache:
+        cache.enabled = False
+
+    # Rate budgets come from RPM_LIMIT / TPM_LIMIT via the shared limiter
+    controller = AdaptiveConcurrency(
+        initial=args.concurrency,
+        maximum=max(args.max_concurrency, args.concurrency),
+        target_latency=args.target_latency,
+    )
+    client = AsyncLLMClient(model=models[0], concurrency=controller)
+    budget = context_budget(args)
+    asyncio.run(run_sweep(cells, samples, client, controller, methods, args.prompt_layout, args.fused_first_stage,
+                          budget))
+
+    manifest = {
+        "cells": [cell["name"] for cell in cells],
+        "models": models,
+        "temperatures": temperatures,
+        "prompt_variants": variants,
+        "concurrency": args.concurrency,
+        "max_concurrency": controller.maximum,
+        "final_concurrency_limit": int(controller.limit),
+        "response_cache": cache.stats(),
+        "prompt_layout": args.prompt_layout,
+        "fused_first_stage": args.fused_first_stage,
+        "context_budget": budget.describe(),
+        "prompt_cache": client.usage.stats(),
+        "response_format": RESPONSE_FORMAT,
+        "repaired_replies": client.repaired_replies,
+        "timestamp": datetime.now().isoformat(),
+    }
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest_path = os.path.join(args.output_dir, "sweep.json")
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    print("Wrote:", manifest_path)
+
+
+if __name__ == "__main__":
+    main()
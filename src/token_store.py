@@ -0,0 +1,192 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+from array import array
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+TOKEN_STORE_DIR = os.path.join(ROOT, ".cache", "token_store", "qrecc-test")
+
+# Same tokenization as data_prep.tokenize / metrics_engine.bleu_tokenize
+TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+TEXT_COLUMNS = ("question", "rewrite", "context")
+# Bumped whenever the set of columns changes; older stores are rebuilt
+STORE_VERSION = 2
+
+
+def tokenize(text: str):
+    return TOKEN_RE.findall(text.lower())
+
+
+def example_key(d):
+    ctx = d.get("Context") or []
+    raw = json.dumps([ctx, d.get("Question", "")], ensure_ascii=False)
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).digest()
+
+
+def source_fingerprint(path):
+    st = os.stat(path)
+    return {"path": os.path.abspath(path), "size": st.st_size, "mtime": st.st_mtime}
+
+
+class TokenStoreBuilder:
+    # Accumulates token ids into flat int32 columns plus int64 offset tables;
+    # context turns get a two-level table (example -> turns -> tokens)
+    def __init__(self):
+        self.vocab = {}
+        self.conversation_no = array("i")
+        self.turn_no = array("i")
+        self.ids = {name: array("i") for name in TEXT_COLUMNS}
+        self.offsets = {name: array("q", [0]) for name in TEXT_COLUMNS}
+        self.context_offsets = array("q", [0])
+        # Per-example (Context, Question) digests and missing Question/Rewrite flags,
+        # so data_prep.py can recompute its stats without re-reading the JSON
+        self.example_keys = bytearray()
+        self.missing_fields = array("B")
+
+    def _encode(self, text, column):
+        ids = self.ids[column]
+        for tok in tokenize(text or ""):
+            tok_id = self.vocab.get(tok)
+            if tok_id is None:
+                tok_id = self.vocab[tok] = len(self.vocab)
+            ids.append(tok_id)
+        self.offsets[column].append(len(ids))
+
+    def add(self, d):
+        self.conversation_no.append(int(d.get("Conversation_no") or 0))
+        self.turn_no.append(int(d.get("Turn_no") or 0))
+        self._encode(d.get("Question", ""), "question")
+        self._encode(d.get("Rewrite", ""), "rewrite")
+        for turn in d.get("Context") or []:
+            self._encode(turn, "context")
+        self.context_offsets.append(len(self.offsets["context"]) - 1)
+        self.example_keys += example_key(d)
+        self.missing_fields.append(not d.get("Question") or not d.get("Rewrite"))
+
+    def save(self, out_dir, source=None):
+        os.makedirs(out_dir, exist_ok=True)
+        np.save(os.path.join(out_dir, "conversation_no.npy"), np.frombuffer(self.conversation_no, dtype=np.int32))
+        np.save(os.path.join(out_dir, "turn_no.npy"), np.frombuffer(self.turn_no, dtype=np.int32))
+        for name in TEXT_COLUMNS:
+            np.save(os.path.join(out_dir, f"{name}_ids.npy"), np.frombuffer(self.ids[name], dtype=np.int32))
+            np.save(os.path.join(out_dir, f"{name}_offsets.npy"), np.frombuffer(self.offsets[name], dtype=np.int64))
+        np.save(os.path.join(out_dir, "context_turn_offsets.npy"), np.frombuffer(self.context_offsets, dtype=np.int64))
+        np.save(os.path.join(out_dir, "example_keys.npy"),
+                np.frombuffer(bytes(self.example_keys), dtype=np.uint8).reshape(-1, 16))
+        np.save(os.path.join(out_dir, "missing_fields.npy"), np.frombuffer(self.missing_fields, dtype=np.uint8))
+        vocab = sorted(self.vocab, key=self.vocab.get)
+        with open(os.path.join(out_dir, "vocab.json"), "w") as f:
+            json.dump(vocab, f, ensure_ascii=False)
+        meta = {
+            "version": STORE_VERSION,
+            "n_examples": len(self.conversation_no),
+            "vocab_size": len(vocab),
+            "token_pattern": TOKEN_RE.pattern,
+            "source": source,
+        }
+        with open(os.path.join(out_dir, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+
+
+class TokenStore:
+    # Read-only, memory-mapped view of a store written by TokenStoreBuilder
+    def __init__(self, store_dir):
+        self.dir = store_dir
+        with open(os.path.join(store_dir, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        self.conversation_no = self._load("conversation_no")
+        self.turn_no = self._load("turn_no")
+        self.ids = {name: self._load(f"{name}_ids") for name in TEXT_COLUMNS}
+        self.offsets = {name: self._load(f"{name}_offsets") for name in TEXT_COLUMNS}
+        self.context_offsets = self._load("context_turn_offsets")
+        self.example_keys = self._load("example_keys")
+        self.missing_fields = self._load("missing_fields")
+        self._vocab = None
+        self._token_ids = None
+        self._rows = None
+
+    def _load(self, name):
+        return np.load(os.path.join(self.dir, f"{name}.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.conversation_no)
+
+    @property
+    def vocab(self):
+        if self._vocab is None:
+            with open(os.path.join(self.dir, "vocab.json"), "r") as f:
+                self._vocab = json.load(f)
+        return self._vocab
+
+    def token_id(self, token):
+        if self._token_ids is None:
+            self._token_ids = {tok: i for i, tok in enumerate(self.vocab)}
+        return self._token_ids.get(token)
+
+    def row(self, example_id):
+        if self._rows is None:
+            self._rows = {f"{c}_{t}": i for i, (c, t) in enumerate(zip(self.conversation_no.tolist(),
+                                                                        self.turn_no.tolist()))}
+        return self._rows.get(example_id)
+
+    def lengths(self, column):
+        # Tokens per example for question/rewrite; turns per example for context
+        if column == "context":
+            return np.diff(self.context_offsets)
+        return np.diff(self.offsets[column])
+
+    def tokens(self, column, i):
+        start, end = self.offsets[column][i], self.offsets[column][i + 1]
+        return self.ids[column][start:end]
+
+    def context_turns(self, i):
+        first, last = self.context_offsets[i], self.context_offsets[i + 1]
+        return [self.tokens("context", t) for t in range(first, last)]
+
+    def decode(self, ids):
+        vocab = self.vocab
+        return [vocab[i] for i in ids]
+
+
+def load_token_store(store_dir=TOKEN_STORE_DIR, source=None):
+    # Returns None when the store is missing, predates STORE_VERSION or was built
+    # from a different file
+    meta_path = os.path.join(store_dir, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, "r") as f:
+        if json.load(f).get("version") != STORE_VERSION:
+            return None
+    store = TokenStore(store_dir)
+    if source is not None and store.meta.get("source") != source_fingerprint(source):
+        return None
+    return store
+
+
+def length_stats(store):
+    out = {}
+    for column in TEXT_COLUMNS:
+        lens = store.lengths(column)
+        out[f"{column}_len_mean"] = float(np.mean(lens))
+        out[f"{column}_len_std"] = float(np.std(lens))
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect a tokenized QReCC store built by data_prep.py")
+    parser.add_argument("store_dir", nargs="?", default=TOKEN_STORE_DIR)
+    args = parser.parse_args()
+
+    store = load_token_store(args.store_dir)
+    if store is None:
+        raise FileNotFoundError("Run data_prep.py --token-store first")
+    print(json.dumps({"n_examples": len(store), **length_stats(store)}, indent=2))
+
+
+if __name__ == "__main__":
+    main()